@@ -1,18 +1,26 @@
+import hashlib
 import logging
 import threading
+import time
+from typing import Optional, Tuple
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
+from jose import JWTError, jwt
 from pydantic import BaseModel
 from supabase import Client, create_client
 
 from app.core.config import settings
+from app.services.cache import MemoryLRUCache
 
 logger = logging.getLogger(__name__)
 
 
 # Dummy endpoint for Swagger (since we use Supabase external auth)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/login")
+# Streams SSE: EventSource (navegador) no puede enviar headers
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/login", auto_error=False)
 
 
 # Lazy loading Supabase Client with atomic initialization
@@ -34,22 +42,102 @@ class AuthUser(BaseModel):
     id: str
     email: str
 
+# Tokens ya verificados (clave: sha256 del token), válidos hasta su `exp`
+_verified_tokens = MemoryLRUCache("auth_tokens", max_entries=settings.AUTH_TOKEN_CACHE_MAX_ENTRIES)
+
+
+def _verify_local(token: str) -> Tuple[AuthUser, Optional[float]]:
+    """Verifica firma HS256 y expiración con SUPABASE_JWT_SECRET, sin red."""
+    claims = jwt.decode(
+        token,
+        settings.SUPABASE_JWT_SECRET,
+        algorithms=["HS256"],
+        audience=settings.SUPABASE_JWT_AUDIENCE or None,
+        options={"verify_aud": bool(settings.SUPABASE_JWT_AUDIENCE)},
+    )
+    if not claims.get("sub"):
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    return AuthUser(id=claims["sub"], email=claims.get("email") or ""), claims.get("exp")
+
+
+async def _verify_remote(token: str) -> Tuple[AuthUser, Optional[float]]:
+    """Verificación contra Supabase Auth, fuera del event loop."""
+    client = get_supabase()
+    
+    # Supabase-py 'get_user' verifies the JWT (cliente síncrono -> threadpool)
+    user_response = await run_in_threadpool(client.auth.get_user, token)
+    
+    if not user_response or not user_response.user:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    
+    user_data = user_response.user
+    try:
+        exp = jwt.get_unverified_claims(token).get("exp")
+    except JWTError:
+        exp = None
+    return AuthUser(id=user_data.id, email=user_data.email or ""), exp
+
+
+def _cache_ttl(exp: Optional[float], max_ttl: Optional[float]) -> float:
+    now = time.time()
+    ttl = (float(exp) - now) if exp else (max_ttl or 0)
+    if max_ttl:
+        ttl = min(ttl, max_ttl)
+    return ttl
+
+
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> AuthUser:
+    return await authenticate(token)
+
+
+async def get_current_user_stream(
+    header_token: Optional[str] = Depends(oauth2_scheme_optional),
+    token: Optional[str] = Query(None, description="JWT para clientes EventSource (sin header Authorization)")
+) -> AuthUser:
+    """
+    Como get_current_user, pero acepta el token también como `?token=`.
+    Solo para endpoints SSE: el query string puede quedar en logs de acceso.
+    """
+    credential = header_token or token
+    if not credential:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return await authenticate(credential)
+
+
+async def authenticate(token: str) -> AuthUser:
+    """Verifica el JWT (local con SUPABASE_JWT_SECRET o contra Supabase) con cache hasta su exp."""
+    cache_key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    cached = _verified_tokens.get_nowait(cache_key)
+    if cached is not None:
+        return AuthUser(**cached)
+    
     try:
-        client = get_supabase()
-        
-        # Supabase-py 'get_user' verifies the JWT
-        user_response = client.auth.get_user(token)
-        
-        if not user_response or not user_response.user:
-            raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+        if settings.SUPABASE_JWT_SECRET:
+            user, exp = _verify_local(token)
+            # Firma local: el token es válido hasta su exp
+            ttl = _cache_ttl(exp, None)
+        else:
+            user, exp = await _verify_remote(token)
+            # Verificación remota: re-chequear periódicamente (revocaciones)
+            ttl = _cache_ttl(exp, settings.AUTH_REMOTE_CACHE_TTL_SEC)
         
-        user_data = user_response.user
-        return AuthUser(id=user_data.id, email=user_data.email or "")
+        if ttl > 0:
+            _verified_tokens.set_nowait(cache_key, user.model_dump(), ttl=ttl)
+        return user
         
     except HTTPException:
         # Re-raise HTTPExceptions (like the 401 above) directly
         raise
+    except JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        ) from None
     except Exception as e:
         # Log minimal details for unexpected errors
         logger.error(f"Unexpected authentication error: {type(e).__name__}")
@@ -58,4 +146,3 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> AuthUser:
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         ) from None
-
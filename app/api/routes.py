@@ -1,20 +1,33 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks, Form
-from typing import List, Optional
+from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks, Form, Request, Query
+from fastapi.responses import StreamingResponse
+from typing import List, Optional, Dict, Any, Tuple
+from datetime import datetime
+from beanie import PydanticObjectId
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError
 from app.schemas.fibo import (
     Campaign, CampaignCreate, 
+    BrandGuidelines,
+    PresignedUploadRequest, FinalizeUploadRequest,
     Product, 
     Plan, PlanRequest, 
     BriaStructuredPrompt,
     ExecuteRequest,
     BriaParameters,
     ProposedVariation,
+    PlanSummary, PlanPage,
 )
 import json
+import time
+import base64
+import asyncio
 import traceback
-from app.services.storage import upload_image_to_supabase
-from app.services.agent import brand_guidelines_to_variations
+from app.services import storage
+from app.services.storage import store_image
+from app.services.agent import brand_guidelines_to_variations, invalidate_campaign_variations
 from app.services.bria import generate_with_fibo, batch_generate, BriaAPIError
-from app.services import jobs
+from app.services import background, jobs, job_queue, mirror, derivatives, prompt_patch
+from app.core.config import settings
 import uuid
 import logging
 from app.api import deps
@@ -23,6 +36,14 @@ from fastapi import Depends
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
+# Tamaño máximo de imágenes subidas
+MAX_IMAGE_BYTES = 10 * 1024 * 1024  # 10MB
+
+# Intervalo de keep-alive de los streams SSE
+SSE_KEEPALIVE_SEC = 15
+# Relectura incremental del job desde MongoDB cuando el stream queda inactivo
+SSE_DB_REFRESH_SEC = 2
+
 # 1. Gestión de Campañas
 @router.post("/campaigns", response_model=Campaign)
 async def create_campaign(
@@ -39,6 +60,23 @@ async def create_campaign(
     logger.info(f"Campaña creada: {new_campaign.id}")
     return new_campaign
 
+@router.put("/campaigns/{campaign_id}/brand-guidelines", response_model=Campaign)
+async def update_brand_guidelines(
+    campaign_id: str,
+    brand_guidelines: BrandGuidelines,
+    current_user: deps.AuthUser = Depends(deps.get_current_user)
+):
+    """Actualiza las brand guidelines e invalida los planes memoizados de la campaña"""
+    campaign = await Campaign.get(campaign_id)
+    if not campaign or campaign.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Campaña no encontrada")
+    
+    campaign.brand_guidelines = brand_guidelines
+    await campaign.save()
+    await invalidate_campaign_variations(campaign_id)
+    logger.info(f"Brand guidelines actualizadas: {campaign.id}")
+    return campaign
+
 # 2. Ingesta de Producto
 @router.post("/campaigns/{campaign_id}/upload-product")
 async def upload_product(
@@ -53,17 +91,20 @@ async def upload_product(
     if not campaign or campaign.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Campaña no encontrada")
     
-    public_url = await upload_image_to_supabase(file, user_id=current_user.id)
-    if not public_url:
+    stored = await store_image(file, user_id=current_user.id)
+    if not stored:
         raise HTTPException(status_code=500, detail="Error subiendo imagen")
+    public_url = stored.url
     
     new_product = Product(
         campaign_id=str(campaign.id),
         image_url=public_url,
         original_filename=file.filename or "unknown",
-        user_id=current_user.id
+        user_id=current_user.id,
+        content_hash=stored.sha256
     )
     await new_product.insert()
+    derivatives.schedule_product(str(new_product.id), stored)
     
     logger.info(f"Producto subido: {new_product.id}")
     
@@ -73,6 +114,98 @@ async def upload_product(
         "message": "Imagen guardada en Supabase y MongoDB"
     }
 
+# 2b. Subida directa a storage (presigned POST + finalize)
+@router.post("/campaigns/{campaign_id}/upload-url")
+async def create_upload_url(
+    campaign_id: str,
+    request: PresignedUploadRequest,
+    current_user: deps.AuthUser = Depends(deps.get_current_user)
+):
+    """Entrega un POST prefirmado (acotado a MAX_IMAGE_BYTES) para subir la imagen directo al bucket"""
+    campaign = await Campaign.get(campaign_id)
+    if not campaign or campaign.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Campaña no encontrada")
+    
+    if not request.content_type.startswith("image/"):
+        raise HTTPException(400, "File must be an image using a supported format (jpeg, png, etc.)")
+    if request.size is not None and request.size > MAX_IMAGE_BYTES:
+        raise HTTPException(400, "Image size exceeds maximum limit of 10MB")
+    
+    upload = storage.create_presigned_upload(
+        current_user.id, request.filename, request.content_type, MAX_IMAGE_BYTES
+    )
+    if not upload:
+        raise HTTPException(status_code=500, detail="Error generando URL de subida")
+    return upload
+
+@router.post("/campaigns/{campaign_id}/finalize-upload")
+async def finalize_upload(
+    campaign_id: str,
+    request: FinalizeUploadRequest,
+    current_user: deps.AuthUser = Depends(deps.get_current_user)
+):
+    """
+    Verifica el objeto subido con el POST prefirmado y crea el Product.
+    Idempotente: reintentar con la misma clave devuelve el mismo producto.
+    """
+    campaign = await Campaign.get(campaign_id)
+    if not campaign or campaign.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Campaña no encontrada")
+    
+    # Solo se pueden finalizar claves emitidas para este usuario
+    if not request.key.startswith(storage.direct_upload_prefix(current_user.id)) or ".." in request.key:
+        raise HTTPException(status_code=400, detail="Clave de subida inválida")
+    
+    def _response(product: Product) -> Dict[str, Any]:
+        return {
+            "product_id": str(product.id),
+            "url": product.image_url,
+            "message": "Imagen verificada en Supabase y guardada en MongoDB"
+        }
+    
+    existing = await Product.find_one(Product.user_id == current_user.id, Product.storage_key == request.key)
+    if existing:
+        if existing.campaign_id != str(campaign.id):
+            raise HTTPException(status_code=409, detail="La subida ya fue finalizada en otra campaña")
+        return _response(existing)
+    
+    head = await storage.head_object(request.key)
+    if not head:
+        raise HTTPException(status_code=404, detail="El archivo no fue subido")
+    if head.get("ContentLength", 0) > MAX_IMAGE_BYTES:
+        await storage.delete_object(request.key)
+        raise HTTPException(status_code=400, detail="El archivo subido excede 10MB")
+    
+    # El Content-Type lo declara el cliente: validar por los bytes reales (solo la cabecera)
+    first_bytes = await storage.read_object_head(request.key)
+    if first_bytes is None:
+        raise HTTPException(status_code=404, detail="El archivo no fue subido")
+    if not storage.sniff_image_type(first_bytes):
+        await storage.delete_object(request.key)
+        raise HTTPException(status_code=400, detail="El archivo subido no es una imagen válida")
+    
+    new_product = Product(
+        campaign_id=str(campaign.id),
+        image_url=storage.public_url_for(request.key),
+        original_filename=request.original_filename or request.key.rsplit("/", 1)[-1],
+        user_id=current_user.id,
+        storage_key=request.key
+    )
+    try:
+        await new_product.insert()
+    except DuplicateKeyError:
+        # Finalize concurrente de la misma clave: gana el primero
+        new_product = await Product.find_one(
+            Product.user_id == current_user.id, Product.storage_key == request.key
+        ) or new_product
+        return _response(new_product)
+    
+    # Hash, deduplicación y miniaturas fuera del request: los bytes no pasan por acá
+    derivatives.schedule_product_upload(str(new_product.id))
+    
+    logger.info(f"Producto subido (directo): {new_product.id}")
+    return _response(new_product)
+
 # Generate Plan con AI Agent
 @router.post("/campaigns/{campaign_id}/generate-plan", response_model=Plan)
 async def generate_plan(
@@ -99,7 +232,9 @@ async def generate_plan(
         variations = await brand_guidelines_to_variations(
             brand_guidelines=campaign.brand_guidelines,
             product_description=f"Producto: {product.original_filename}",
-            variations_count=request.variations_count
+            variations_count=request.variations_count,
+            campaign_id=campaign_id,
+            fresh=request.fresh
         )
     except Exception as e:
         logger.error(f"Error generando variaciones: {str(e)}")
@@ -151,7 +286,8 @@ async def execute_plan(
     try:
         results = await batch_generate(
             [v.bria_parameters for v in selected_variations],
-            mode="generate"
+            mode="generate",
+            use_cache=not request.bypass_cache
         )
     except BriaAPIError as e:
         logger.error(f"Error en FIBO API: {str(e)}")
@@ -165,8 +301,13 @@ async def execute_plan(
             plan.proposed_variations[idx].json_prompt = result.get("structured_prompt")
     
     plan.status = "completed"
+    prompt_patch.compact_plan(plan)
+    mirror.mark_pending(plan)
     await plan.save()
     
+    # Copiar los resultados a nuestro bucket antes de que expiren
+    mirror.schedule(mirror.mirror_plan(str(plan.id)))
+    
     logger.info(f"Plan ejecutado exitosamente: {plan.id}")
     
     return {
@@ -176,6 +317,47 @@ async def execute_plan(
         "results": results
     }
 
+def _encode_cursor(plan: PlanSummary) -> str:
+    raw = json.dumps({"c": plan.created_at.isoformat(), "i": str(plan.id)})
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, PydanticObjectId]:
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(raw["c"]), PydanticObjectId(raw["i"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+# History paginado por cursor (debe declararse antes de /plans/{plan_id})
+@router.get("/plans/history", response_model=PlanPage)
+async def list_plan_history(
+    current_user: deps.AuthUser = Depends(deps.get_current_user),
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100)
+):
+    """
+    Historial del usuario paginado por cursor (created_at, _id), más reciente primero.
+    Devuelve resúmenes sin structured prompts; el detalle está en GET /plans/{plan_id}.
+    """
+    query: Dict[str, Any] = {"user_id": current_user.id}
+    if cursor:
+        created_at, last_id = _decode_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": last_id}},
+        ]
+    
+    items = await (
+        Plan.find(query)
+        .sort([("created_at", DESCENDING), ("_id", DESCENDING)])
+        .limit(limit + 1)
+        .project(PlanSummary)
+        .to_list()
+    )
+    has_more = len(items) > limit
+    items = items[:limit]
+    return PlanPage(items=items, next_cursor=_encode_cursor(items[-1]) if has_more else None)
+
 # Get Plan (útil para ver resultados)
 @router.get("/plans/{plan_id}", response_model=Plan)
 async def get_plan(
@@ -186,17 +368,29 @@ async def get_plan(
     plan = await Plan.get(plan_id)
     if not plan or plan.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Plan no encontrado")
-    return plan
+    # Los prompts se guardan como base + patches; la API los devuelve completos
+    return prompt_patch.expand_plan(plan)
 
 # List User Plans (History)
-@router.get("/plans", response_model=List[Plan])
+@router.get("/plans", response_model=List[PlanSummary], deprecated=True)
 async def list_plans(
     current_user: deps.AuthUser = Depends(deps.get_current_user),
-    skip: int = 0,
-    limit: int = 50
+    skip: int = Query(0, ge=0, deprecated=True),
+    limit: int = Query(20, ge=1, le=100)
 ):
-    """Lista todos los planes (historial) del usuario, ordenados por fecha"""
-    return await Plan.find(Plan.user_id == current_user.id).sort("-created_at").skip(skip).limit(limit).to_list()
+    """
+    Lista los planes (historial) del usuario, ordenados por fecha.
+    Obsoleto: usar GET /plans/history (cursor); `skip` recorre todo lo salteado.
+    Devuelve resúmenes sin structured prompts, igual que el historial.
+    """
+    return await (
+        Plan.find(Plan.user_id == current_user.id)
+        .sort([("created_at", DESCENDING), ("_id", DESCENDING)])
+        .skip(skip)
+        .limit(limit)
+        .project(PlanSummary)
+        .to_list()
+    )
 
 # List Campaigns
 @router.get("/campaigns", response_model=List[Campaign])
@@ -213,7 +407,6 @@ async def list_campaigns(current_user: deps.AuthUser = Depends(deps.get_current_
 
 @router.post("/generate-async")
 async def generate_async(
-    background_tasks: BackgroundTasks,
     prompt: str = Form(...),
     image: UploadFile = File(None),
     brand_guidelines: str = Form(None),
@@ -227,6 +420,7 @@ async def generate_async(
     """
     # 1. Upload Image if present
     public_url = None
+    image_hash = None
     if image:
         # Validate Content-Type
         if not image.content_type or not image.content_type.startswith("image/"):
@@ -237,133 +431,48 @@ async def generate_async(
         file_size = image.file.tell()
         image.file.seek(0)
         
-        if file_size > 10 * 1024 * 1024: # 10MB
+        if file_size > MAX_IMAGE_BYTES:
             raise HTTPException(400, "Image size exceeds maximum limit of 10MB")
 
-        public_url = await upload_image_to_supabase(image, user_id=current_user.id)
-        if not public_url:
+        stored = await store_image(image, user_id=current_user.id)
+        if not stored:
             raise HTTPException(500, "Failed to upload input image to storage.")
+        public_url, image_hash = stored.url, stored.sha256
     
     # Validate Variations
     if variations < 1 or variations > 8:
         raise HTTPException(status_code=400, detail="Variations must be between 1 and 8")
 
     # 2. Create Job
-    job = await jobs.create_job(prompt, brand_guidelines, variations, aspect_ratio, public_url, user_id=current_user.id)
-    
-    # 3. Start Background Task
-    background_tasks.add_task(
-        process_generation_job, 
-        job.job_id, 
-        prompt, 
-        public_url, 
-        variations, 
-        brand_guidelines,
-        current_user.id,  # PASS USER ID
-        aspect_ratio      # PASS ASPECT RATIO
-    )
+    job = await jobs.create_job(prompt, brand_guidelines, variations, aspect_ratio, public_url, user_id=current_user.id, image_hash=image_hash)
+    
+    # 3. Ejecutar en este proceso o dejarlo a los workers de la cola
+    if settings.JOB_QUEUE_MODE == "background":
+        # Tarea rastreada: al apagar se cancela tras la gracia y el lease la reencola
+        background.spawn(job_queue.run_inline(job.job_id))
     
     return {"job_id": job.job_id, "status": "queued"}
 
-# Redefine process_generation_job to include persistence
-async def process_generation_job(
-    job_id: str, 
-    prompt: str, 
-    image_url: Optional[str] = None, 
-    variations: int = 4, 
-    brand_guidelines: Optional[str] = None,
-    user_id: Optional[str] = None, # Now accepts user_id
-    aspect_ratio: str = "1:1" # New param
-):
-    try:
-        await jobs.update_job(job_id, stage=jobs.JobStage.STARTED, progress=10)
-        
-        # Use Orchestrator if available for smarter generation, or fallback to loop
-        # For simplicity and robust persistence, we use the loop but save to DB.
-        
-        results = []
-        proposed_vars = [] # To save in Plan
-        
-        effective_prompt = prompt
-        if brand_guidelines:
-            effective_prompt = f"{prompt}. Context: {brand_guidelines}"
-        
-        for i in range(variations):
-            progress_step = 10 + int((i / variations) * 80)
-            await jobs.update_job(job_id, progress=progress_step)
-            await jobs.add_event(job_id, f"Generating variation {i+1}/{variations}...")
-            
-            mode = "inspire" if image_url else "generate"
-            
-            params = BriaParameters(
-                prompt=effective_prompt,
-                reference_image_url=image_url,
-                camera_angle="eye_level",
-                seed=None,
-                aspect_ratio=aspect_ratio
-            )
-            
-            try:
-                # Use Smart Agent if integrated? 
-                # For now, stick to direct bria call which is working.
-                res = await generate_with_fibo(params, mode=mode)
-                
-                if res.get("image_url"):
-                    img_url = res["image_url"]
-                    await jobs.add_result(job_id, img_url)
-                    results.append(img_url)
-                    
-                    # Handle SP format
-                    sp = res.get("structured_prompt", {})
-                    if isinstance(sp, str):
-                        try:
-                            sp = json.loads(sp)
-                        except json.JSONDecodeError:
-                            sp = {}
-                            
-                    # Add to proposed vars for persistence
-                    proposed_vars.append(ProposedVariation(
-                        concept_name=f"Quick Gen {i+1}",
-                        bria_parameters=params,
-                        generated_image_url=img_url,
-                        json_prompt=sp
-                    ))
-                    
-            except Exception as e:
-                logger.error(f"Error generating variation {i}: {e}")
-                await jobs.add_event(job_id, f"Error on var {i+1}: {str(e)}")
-        
-        if not results:
-             raise Exception("No images could be generated.")
-
-        await jobs.complete_job(job_id, results)
-        
-        # PERSIST TO MONGODB (PLAN HISTORY)
-        if user_id and proposed_vars:
-            try:
-                # Ensure imports again just in case scope issue
-                from app.schemas.fibo import Plan
-                
-                new_plan = Plan(
-                    campaign_id="playground",  # Generic campaign
-                    product_id="direct_upload",
-                    proposed_variations=proposed_vars,
-                    status="completed",
-                    user_id=user_id
-                )
-                await new_plan.insert()
-                logger.info(f"Persisted job {job_id} as Plan {new_plan.id} for user {user_id}")
-            except Exception as db_e:
-                logger.exception(f"Failed to persist plan to MongoDB: {db_e}")
-                
-    except Exception as e:
-        logger.exception(f"Job {job_id} failed")
-        await jobs.fail_job(job_id, str(e), trace=traceback.format_exc())
-
 @router.get("/jobs/{job_id}")
-async def get_job_status(job_id: str, current_user: deps.AuthUser = Depends(deps.get_current_user)):
-    """Obtiene el estado de un trabajo de generación en segundo plano"""
-    status = await jobs.get_job_status(job_id)
+async def get_job_status(
+    job_id: str,
+    current_user: deps.AuthUser = Depends(deps.get_current_user),
+    since: Optional[int] = None,
+    fields: Optional[str] = None
+):
+    """
+    Obtiene el estado de un trabajo de generación en segundo plano.
+    - since: devuelve solo eventos/partial_results posteriores (usar `next_since` de la respuesta anterior)
+    - fields: lista separada por comas, p.ej. "stage,progress,events"
+    """
+    selected = None
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = set(selected) - jobs.STATUS_FIELDS
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Campos desconocidos: {', '.join(sorted(unknown))}")
+    
+    status = await jobs.get_job_status(job_id, since=since, fields=selected)
     if not status:
         raise HTTPException(status_code=404, detail="Job not found")
         
@@ -372,3 +481,104 @@ async def get_job_status(job_id: str, current_user: deps.AuthUser = Depends(deps
         raise HTTPException(status_code=404, detail="Job not found")
         
     return status
+
+# Campos que relee el refresco periódico del stream SSE
+SSE_STATUS_FIELDS = ["stage", "progress", "error", "plan_id", "results"]
+
+def _status_diff(old: Dict[str, Any], new: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Mensajes equivalentes al pub/sub a partir de una lectura incremental del job
+    (`new` trae solo eventos/partial_results posteriores al cursor).
+    """
+    messages = []
+    for event in new.get("events", []):
+        messages.append({"type": "event", "data": event})
+    for partial in new.get("partial_results", []):
+        messages.append({"type": "partial_result", "data": partial})
+    for url in new.get("results", []):
+        if url not in old.get("results", []):
+            messages.append({"type": "result", "data": {"image_url": url}})
+    changed = {k: new.get(k) for k in ("stage", "progress", "error", "plan_id") if new.get(k) != old.get(k)}
+    if changed:
+        messages.append({"type": "update", "data": changed})
+    return messages
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str, ensure_ascii=False)}\n\n"
+
+@router.get("/jobs/{job_id}/stream")
+async def stream_job_status(
+    job_id: str,
+    request: Request,
+    current_user: deps.AuthUser = Depends(deps.get_current_user_stream)
+):
+    """
+    Stream SSE del progreso de un job (reemplaza el polling de /jobs/{job_id}).
+    Acepta el token como `?token=` para clientes EventSource.
+    Envía un 'snapshot' inicial y luego 'update', 'event', 'result' y
+    'partial_result' a medida que ocurren. Se cierra al llegar a DONE/ERROR.
+    """
+    bus = jobs.get_job_event_bus()
+    # Suscribir antes del snapshot para no perder mensajes intermedios
+    queue = bus.subscribe(job_id)
+    
+    status = await jobs.get_job_status(job_id)
+    if not status or (status.get("user_id") and status.get("user_id") != current_user.id):
+        bus.unsubscribe(job_id, queue)
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def event_stream():
+        try:
+            snapshot = {k: v for k, v in status.items() if k != "trace"}
+            yield _sse("snapshot", snapshot)
+            if snapshot.get("stage") in jobs.TERMINAL_STAGES:
+                return
+            
+            # El job puede correr en otro proceso (modo "worker" o varios web
+            # workers): sin mensajes del pub/sub local se relee MongoDB con
+            # lecturas incrementales (since = último cursor)
+            local_producer = False
+            last = snapshot
+            cursor = snapshot.get("next_since")
+            last_write = time.monotonic()
+            
+            while not await request.is_disconnected():
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=SSE_DB_REFRESH_SEC)
+                except asyncio.TimeoutError:
+                    # Productor local: el pub/sub ya entrega la telemetría; solo
+                    # se verifica la etapa por si el cierre se perdió
+                    fields = ["stage"] if local_producer else SSE_STATUS_FIELDS + ["events", "partial_results"]
+                    latest = await jobs.get_job_status(job_id, since=cursor, fields=fields)
+                    if not latest:
+                        return
+                    if not local_producer:
+                        for message in _status_diff(last, latest):
+                            yield _sse(message["type"], message["data"])
+                            last_write = time.monotonic()
+                        last = latest
+                        cursor = latest.get("next_since", cursor)
+                    if latest.get("stage") in jobs.TERMINAL_STAGES:
+                        if local_producer and last.get("stage") != latest["stage"]:
+                            yield _sse("update", {"stage": latest["stage"]})
+                        return
+                    if time.monotonic() - last_write >= SSE_KEEPALIVE_SEC:
+                        yield ": keep-alive\n\n"
+                        last_write = time.monotonic()
+                    continue
+                
+                local_producer = True
+                yield _sse(message["type"], message["data"])
+                last_write = time.monotonic()
+                if message["type"] == "update" and "stage" in message["data"]:
+                    last = {**last, "stage": message["data"]["stage"]}
+                if message["type"] == "update" and message["data"].get("stage") in jobs.TERMINAL_STAGES:
+                    return
+        finally:
+            bus.unsubscribe(job_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,4 +1,5 @@
 import os
+from pydantic import field_validator
 from pydantic_settings import BaseSettings
 from typing import Optional
 
@@ -13,6 +14,72 @@ class Settings(BaseSettings):
     BRIA_API_URL: str = "https://engine.prod.bria-api.com/v2"
     BRIA_IMAGE_GENERATE_ENDPOINT: str = "/image/generate"
     BRIA_STRUCTURED_PROMPT_ENDPOINT: str = "/v2/structured_prompt/generate"
+    # Polling de jobs async de Bria v2 (backoff adaptativo)
+    DEFAULT_TIMEOUT_SEC: float = float(os.getenv("BRIA_TIMEOUT_SEC", "300"))
+    BRIA_POLL_MIN_SEC: float = float(os.getenv("BRIA_POLL_MIN_SEC", "0.5"))
+    BRIA_POLL_MAX_SEC: float = float(os.getenv("BRIA_POLL_MAX_SEC", "5"))
+    BRIA_POLL_BACKOFF: float = float(os.getenv("BRIA_POLL_BACKOFF", "1.5"))
+    BRIA_POLL_MAX_IN_FLIGHT: int = int(os.getenv("BRIA_POLL_MAX_IN_FLIGHT", "32"))  # GETs simultáneos del poller central
+    BRIA_POLL_JITTER: float = float(os.getenv("BRIA_POLL_JITTER", "0.2"))  # ±20% sobre el intervalo de poll
+    BRIA_MAX_CONCURRENCY: int = int(os.getenv("BRIA_MAX_CONCURRENCY", "4"))  # Generaciones simultáneas por batch
+    
+    # Cache de generaciones FIBO (solo requests con seed fijo, deterministas).
+    # Backend: "memory", "mongo", "tiered" o "none". El TTL debe ser menor que
+    # la expiración de las URLs firmadas que devuelve Bria.
+    GENERATION_CACHE_BACKEND: str = os.getenv("GENERATION_CACHE_BACKEND", "memory")
+    GENERATION_CACHE_TTL_SEC: float = float(os.getenv("GENERATION_CACHE_TTL_SEC", "3600"))
+    GENERATION_CACHE_MAX_ENTRIES: int = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", "1000"))
+    
+    # Cache de análisis de imagen (structured prompt base) por hash de imagen + prompt
+    SP_CACHE_TTL_SEC: float = float(os.getenv("SP_CACHE_TTL_SEC", "86400"))
+    SP_CACHE_MAX_ENTRIES: int = int(os.getenv("SP_CACHE_MAX_ENTRIES", "256"))
+    
+    # Memoización de planes del agente LLM (generate-plan)
+    LLM_PLAN_CACHE_BACKEND: str = os.getenv("LLM_PLAN_CACHE_BACKEND", "memory")
+    LLM_PLAN_CACHE_TTL_SEC: float = float(os.getenv("LLM_PLAN_CACHE_TTL_SEC", "21600"))
+    LLM_PLAN_CACHE_MAX_ENTRIES: int = int(os.getenv("LLM_PLAN_CACHE_MAX_ENTRIES", "500"))
+    
+    # Preprocesamiento de la imagen de referencia antes de enviarla a Bria
+    IMAGE_PREPROCESS_MAX_EDGE: int = int(os.getenv("IMAGE_PREPROCESS_MAX_EDGE", "1536"))
+    IMAGE_PREPROCESS_FORMAT: str = os.getenv("IMAGE_PREPROCESS_FORMAT", "WEBP")
+    IMAGE_PREPROCESS_QUALITY: int = int(os.getenv("IMAGE_PREPROCESS_QUALITY", "90"))
+    IMAGE_PREPROCESS_CACHE_ENTRIES: int = int(os.getenv("IMAGE_PREPROCESS_CACHE_ENTRIES", "32"))
+    
+    # Espejado de resultados de Bria (URLs firmadas que expiran) en nuestro bucket
+    MIRROR_RESULTS_ENABLED: bool = os.getenv("MIRROR_RESULTS_ENABLED", "True").lower() == "true"
+    MIRROR_MAX_CONCURRENCY: int = int(os.getenv("MIRROR_MAX_CONCURRENCY", "4"))
+    MIRROR_MAX_ATTEMPTS: int = int(os.getenv("MIRROR_MAX_ATTEMPTS", "3"))
+    
+    # Derivados responsivos (miniaturas) de resultados y productos
+    DERIVATIVES_ENABLED: bool = os.getenv("DERIVATIVES_ENABLED", "True").lower() == "true"
+    DERIVATIVE_SIZES: str = os.getenv("DERIVATIVE_SIZES", "256,512,1024")
+    DERIVATIVE_FORMAT: str = os.getenv("DERIVATIVE_FORMAT", "WEBP")
+    DERIVATIVE_QUALITY: int = int(os.getenv("DERIVATIVE_QUALITY", "80"))
+    DERIVATIVE_WORKERS: int = int(os.getenv("DERIVATIVE_WORKERS", "2"))  # Procesos del pool
+    
+    # Cliente HTTP compartido (pool de conexiones hacia Bria)
+    HTTP_MAX_CONNECTIONS: int = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+    HTTP_KEEPALIVE_EXPIRY_SEC: float = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SEC", "30"))
+    HTTP_TIMEOUT_SEC: float = float(os.getenv("HTTP_TIMEOUT_SEC", "120"))
+    HTTP_CONNECT_TIMEOUT_SEC: float = float(os.getenv("HTTP_CONNECT_TIMEOUT_SEC", "10"))
+    HTTP_ENABLE_HTTP2: bool = os.getenv("HTTP_ENABLE_HTTP2", "True").lower() == "true"
+    
+    # Jobs: intervalo de flush del buffer write-behind (0 = write-through)
+    JOB_BUFFER_FLUSH_SEC: float = float(os.getenv("JOB_BUFFER_FLUSH_SEC", "1.0"))
+    
+    # Cola de jobs: "background" ejecuta en el web worker que recibe el request
+    # (con lease, recuperable por un worker dedicado); "worker" solo encola
+    # y deja la ejecución a `python -m app.worker`
+    JOB_QUEUE_MODE: str = os.getenv("JOB_QUEUE_MODE", "background")
+    JOB_WORKER_CONCURRENCY: int = int(os.getenv("JOB_WORKER_CONCURRENCY", "2"))
+    JOB_QUEUE_POLL_SEC: float = float(os.getenv("JOB_QUEUE_POLL_SEC", "2"))
+    JOB_LEASE_SEC: float = float(os.getenv("JOB_LEASE_SEC", "60"))
+    JOB_HEARTBEAT_SEC: float = float(os.getenv("JOB_HEARTBEAT_SEC", "20"))
+    JOB_MAX_ATTEMPTS: int = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    JOB_RETRY_BACKOFF_SEC: float = float(os.getenv("JOB_RETRY_BACKOFF_SEC", "10"))
+    JOB_SHUTDOWN_GRACE_SEC: float = float(os.getenv("JOB_SHUTDOWN_GRACE_SEC", "20"))  # Al apagar: espera antes de cancelar jobs en vuelo
+    JOB_TTL_SEC: float = float(os.getenv("JOB_TTL_SEC", str(7 * 24 * 3600)))  # Retención de jobs terminados; 0 = nunca expiran
     
     # OpenAI / Compatible LLM (DeepSeek, etc.)
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
@@ -30,6 +97,9 @@ class Settings(BaseSettings):
     SUPABASE_URL: str = os.getenv("SUPABASE_URL", "")
     SUPABASE_KEY: str = os.getenv("SUPABASE_KEY", "") # Service Role Key for Backend or Anon if just verifying
     SUPABASE_JWT_SECRET: str = os.getenv("SUPABASE_JWT_SECRET", "") # Optional for manual verify
+    SUPABASE_JWT_AUDIENCE: str = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+    AUTH_TOKEN_CACHE_MAX_ENTRIES: int = int(os.getenv("AUTH_TOKEN_CACHE_MAX_ENTRIES", "10000"))
+    AUTH_REMOTE_CACHE_TTL_SEC: float = float(os.getenv("AUTH_REMOTE_CACHE_TTL_SEC", "300"))  # Sin JWT secret: re-verificar con Supabase cada 5 min
     
     # S3 Compatibility (Keep existing if relying on boto3)
     SUPABASE_ENDPOINT_URL: str = os.getenv("SUPABASE_ENDPOINT_URL", "")
@@ -44,8 +114,16 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 7 # 1 week
     
     # Application Settings
+    DATA_DIR: str = os.getenv("DATA_DIR", "data")  # Planes del Orchestrator en disco
     DEBUG: bool = os.getenv("DEBUG", "False").lower() == "true"
     
+    @field_validator("MIRROR_MAX_ATTEMPTS", "MIRROR_MAX_CONCURRENCY", "BRIA_POLL_MAX_IN_FLIGHT")
+    @classmethod
+    def _at_least_one(cls, v: int) -> int:
+        # BaseSettings lee la variable de entorno directamente: se acota acá.
+        # 0 dejaría sin intentos o crearía un Semaphore(0) que bloquea para siempre
+        return max(1, v)
+    
     class Config:
         env_file = ".env"
         case_sensitive = True,
@@ -0,0 +1,36 @@
+import os
+import certifi
+from typing import Optional
+from motor.motor_asyncio import AsyncIOMotorClient
+from beanie import init_beanie
+from app.core.config import settings
+from app.schemas.fibo import Campaign, Product, Plan, Job, JobEvent, CacheEntry, StoredImage
+
+# Modelos registrados en Beanie (API y workers comparten la misma lista)
+DOCUMENT_MODELS = [Campaign, Product, Plan, Job, JobEvent, CacheEntry, StoredImage]
+
+async def init_db() -> Optional[AsyncIOMotorClient]:
+    """Conecta a MongoDB e inicializa Beanie. Devuelve None si falta MONGO_URI."""
+    mongo_uri = os.getenv("MONGO_URI")
+    if not mongo_uri:
+        print("ADVERTENCIA: MONGO_URI no está definido")
+        return None
+    
+    client = AsyncIOMotorClient(
+        mongo_uri,
+        tlsCAFile=certifi.where() 
+    )
+    
+    # Initialize Beanie with the Motor client and document models
+    await init_beanie(
+        database=client[settings.DB_NAME], # type: ignore
+        document_models=DOCUMENT_MODELS
+    )
+    return client
+
+def get_collection(model):
+    """Colección cruda de un Document, para operaciones que Beanie no expone (arrayFilters, find-and-modify)."""
+    # Beanie 2.x expone la colección PyMongo async; Beanie 1.x la de Motor
+    if hasattr(model, "get_pymongo_collection"):
+        return model.get_pymongo_collection()
+    return model.get_motor_collection()
@@ -1,40 +1,57 @@
-import os
-import certifi
 from dotenv import load_dotenv
 load_dotenv()
+import asyncio
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 from app.api.routes import router as api_router
-from motor.motor_asyncio import AsyncIOMotorClient
-from beanie import init_beanie
-from app.schemas.fibo import Campaign, Product, Plan, Job
+from app.core.config import settings
+from app.core.db import init_db
+from app.services.http_client import get_http_client, close_http_client
+from app.services.bria_poller import shutdown_status_poller
+from app.services.job_buffer import shutdown_job_buffer
+from app.services import background
+from app.services.derivatives import shutdown_process_pool
+from app.services import job_queue
+from app.worker import JobWorker
 
 # Life cycle of the application
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup logic
-    mongo_uri = os.getenv("MONGO_URI")
-    if not mongo_uri:
-        print("ADVERTENCIA: MONGO_URI no está definido")
-    else:
-        # 2. AGREGAR tlsCAFile=certifi.where() AQUÍ
-        client = AsyncIOMotorClient(
-            mongo_uri,
-            tlsCAFile=certifi.where() 
-        )
-        
-        # Initialize Beanie with the Motor client and document models
-        await init_beanie(
-            database=client.ai_art_director, # type: ignore
-            document_models=[Campaign, Product, Plan, Job]
-        )
+    db_ready = await init_db()
+    if db_ready:
         print("MongoDB Conectado\n")
         print("Backend inicializado")
     
+    # Pool HTTP compartido para Bria (keep-alive entre requests)
+    get_http_client()
+    
+    # Modo background: sin workers dedicados, este proceso también reclama
+    # los jobs reencolados (reintentos) y los de leases vencidos
+    queue_worker = None
+    queue_task = None
+    if db_ready and settings.JOB_QUEUE_MODE == "background":
+        queue_worker = JobWorker(
+            settings.JOB_WORKER_CONCURRENCY,
+            settings.JOB_QUEUE_POLL_SEC,
+            worker_id=job_queue.default_worker_id("web")
+        )
+        queue_task = asyncio.create_task(queue_worker.run())
+    
     yield
     
 
-    # Shutdown logic
+    # Shutdown logic: jobs en vuelo (claim loop e inline) y tareas de fondo
+    # comparten una gracia acotada; lo que no termina se cancela
+    stopping = [background.drain(settings.JOB_SHUTDOWN_GRACE_SEC)]
+    if queue_worker is not None:
+        queue_worker.stop()
+        stopping.append(queue_task)
+    await asyncio.gather(*stopping)
+    shutdown_process_pool()
+    await shutdown_job_buffer()
+    await shutdown_status_poller()
+    await close_http_client()
     print("Backend Apagandose")
 
 # Passing the lifespan to FastAPI
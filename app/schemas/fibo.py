@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional, Literal
+from typing import List, Optional, Literal, Any, Dict
 
 # Estructuras Internas del JSON de Bria v2
 
@@ -51,7 +51,8 @@ class AgentOutput(BaseModel):
     variations: List[BriaStructuredPrompt]
 
 # Modelos de base de datos (usando lo que ya tenías, ajustado)
-from beanie import Document, Indexed
+from beanie import Document, Indexed, PydanticObjectId
+from pymongo import IndexModel, ASCENDING, DESCENDING
 from datetime import datetime
 
 # Component Models
@@ -86,54 +87,121 @@ class ProposedVariation(BaseModel):
     concept_name: str
     bria_parameters: BriaParameters
     generated_image_url: Optional[str] = None  # URL después de generar con FIBO
-    json_prompt: Optional[dict] = None         # JSON estructurado de FIBO
+    json_prompt: Optional[dict] = None         # JSON estructurado de FIBO (completo: planes legados o no expresables como patch)
+    json_prompt_patch: Optional[dict] = None   # Diferencia contra Plan.base_json_prompt (ver app/services/prompt_patch.py)
+    derivative_urls: Optional[Dict[str, str]] = None  # {"256": url, "512": url, ...} miniaturas WEBP
 
 class Campaign(Document):
     name: str
     brand_guidelines: BrandGuidelines
-    user_id: Indexed(str) # type: ignore
+    user_id: str  # indexado vía (user_id, created_at)
     created_at: datetime = Field(default_factory=datetime.now)
 
     class Settings:
         name = "campaigns"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)]),
+        ]
 
 class Product(Document):
     campaign_id: str
     image_url: str
     original_filename: str
-    user_id: Indexed(str) # type: ignore
+    user_id: str  # indexado vía (user_id, campaign_id, created_at)
+    content_hash: Optional[str] = None  # sha256 de la imagen (ver StoredImage)
+    storage_key: Optional[str] = None  # Clave de la subida directa que lo creó (finalize idempotente)
+    derivative_urls: Optional[Dict[str, str]] = None
     created_at: datetime = Field(default_factory=datetime.now)
 
     class Settings:
         name = "products"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("campaign_id", ASCENDING), ("created_at", DESCENDING)]),
+            # Un producto por subida directa (índice parcial: solo los que tienen clave)
+            IndexModel(
+                [("user_id", ASCENDING), ("storage_key", ASCENDING)],
+                unique=True,
+                partialFilterExpression={"storage_key": {"$type": "string"}},
+            ),
+        ]
 
 class Plan(Document):
     campaign_id: str
     product_id: str
     proposed_variations: List[ProposedVariation]
     status: str = "pending"  # pending, executing, completed
-    user_id: Indexed(str) # type: ignore
+    user_id: str  # indexado vía (user_id, created_at, _id)
     created_at: datetime = Field(default_factory=datetime.now)
+    base_json_prompt: Optional[dict] = None  # Structured prompt común a las variaciones
+    job_id: Optional[str] = None  # Job que generó el plan (si vino de la cola)
+    mirror_pending: bool = False  # Espejado programado y no terminado (mirror_history.py lo retoma)
 
     class Settings:
         name = "plans"
+        indexes = [
+            # Historial paginado por cursor: (user_id, created_at, _id)
+            IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+            # Espejados pendientes (índice parcial: solo los planes marcados)
+            IndexModel([("mirror_pending", ASCENDING)], partialFilterExpression={"mirror_pending": True}),
+        ]
+
+# Proyecciones livianas para el historial (sin structured prompts)
+class VariationSummary(BaseModel):
+    concept_name: str
+    generated_image_url: Optional[str] = None
+    derivative_urls: Optional[Dict[str, str]] = None
+
+class PlanSummary(BaseModel):
+    id: PydanticObjectId = Field(alias="_id")
+    campaign_id: str
+    product_id: str
+    proposed_variations: List[VariationSummary] = []
+    status: str
+    created_at: datetime
+
+    class Settings:
+        projection = {
+            "_id": 1,
+            "campaign_id": 1,
+            "product_id": 1,
+            "status": 1,
+            "created_at": 1,
+            "proposed_variations.concept_name": 1,
+            "proposed_variations.generated_image_url": 1,
+            "proposed_variations.derivative_urls": 1,
+        }
+
+class PlanPage(BaseModel):
+    items: List[PlanSummary]
+    next_cursor: Optional[str] = None  # None => no hay más páginas
 
 # Request/Response Models
 class CampaignCreate(BaseModel):
     name: str
     brand_guidelines: BrandGuidelines
 
+class PresignedUploadRequest(BaseModel):
+    filename: str
+    content_type: str
+    size: Optional[int] = None  # Bytes declarados por el cliente (validación temprana)
+
+class FinalizeUploadRequest(BaseModel):
+    key: str
+    original_filename: Optional[str] = None
+
 class PlanRequest(BaseModel):
     product_id: str
     variations_count: int = 3
+    fresh: bool = False  # Pedir una nueva pasada creativa en vez del plan memoizado
 
 class ExecuteRequest(BaseModel):
     plan_id: str
     selected_variations: List[int]  # Índices de variaciones a ejecutar
+    bypass_cache: bool = False      # Forzar nuevas llamadas a FIBO aunque haya resultado cacheado
 
 class Job(Document):
     job_id: Indexed(str, unique=True) # type: ignore
-    user_id: Optional[Indexed(str)] = None # type: ignore
+    user_id: Optional[str] = None  # indexado vía (user_id, updated_at)
     prompt: str
     variations: int = 4
     stage: str = "QUEUED"
@@ -141,7 +209,9 @@ class Job(Document):
     created_at: float = Field(default_factory=lambda: datetime.now().timestamp())
     updated_at: float = Field(default_factory=lambda: datetime.now().timestamp())
     
-    events: List[dict] = []
+    events: List[dict] = []  # Legado: los eventos nuevos van a JobEvent
+    # Secuencia de telemetría: cursor `since` de eventos y partial_results (ver jobs.get_job_status)
+    event_seq: int = 0
     results: List[str] = []
     partial_results: List[dict] = []
     
@@ -150,9 +220,76 @@ class Job(Document):
     
     # Context
     image_path: Optional[str] = None
+    image_hash: Optional[str] = None  # sha256 de la imagen de referencia
     brand_guidelines: Optional[str] = None
     aspect_ratio: Optional[str] = "1:1"
     plan_id: Optional[str] = None
+    
+    # Cola durable (ver app/services/job_queue.py)
+    attempts: int = 0
+    max_attempts: int = 3
+    next_run_at: float = Field(default_factory=lambda: datetime.now().timestamp())
+    lease_expires_at: Optional[float] = None
+    worker_id: Optional[str] = None
+    
+    # Retención: Mongo borra el job al llegar a expires_at (solo jobs terminados)
+    expires_at: Optional[datetime] = None
+
+    class Settings:
+        name = "jobs"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("updated_at", DESCENDING)]),
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+            IndexModel([("stage", ASCENDING), ("next_run_at", ASCENDING)]),
+            IndexModel([("stage", ASCENDING), ("lease_expires_at", ASCENDING)]),
+        ]
+
+class JobEvent(Document):
+    """Log append-only de eventos de un job (uno por documento)."""
+    job_id: str
+    seq: Optional[int] = None  # asignado al persistir (Job.event_seq): orden de commit
+    t: float  # timestamp epoch, igual que Job.updated_at
+    msg: str
+    expires_at: Optional[datetime] = None
+
+    class Settings:
+        name = "job_events"
+        indexes = [
+            IndexModel([("job_id", ASCENDING), ("seq", ASCENDING)]),
+            # TTL: misma retención que los jobs (JOB_TTL_SEC)
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        ]
+
+class StoredImage(Document):
+    """Índice de imágenes subidas por contenido: evita re-subir duplicados"""
+    user_id: str
+    sha256: str
+    key: str
+    url: str
+    size: int
+    content_type: Optional[str] = None
+    derivatives: Optional[Dict[str, str]] = None  # Miniaturas por tamaño (ver app/services/derivatives.py)
+    created_at: datetime = Field(default_factory=datetime.now)
+
+    class Settings:
+        name = "stored_images"
+        indexes = [
+            IndexModel([("user_id", ASCENDING), ("sha256", ASCENDING)], unique=True),
+        ]
+
+class CacheEntry(Document):
+    """Entrada de cache persistente (ver app/services/cache.py)"""
+    namespace: str
+    key: str
+    value: Any = None
+    created_at: datetime = Field(default_factory=datetime.now)
+    expires_at: Optional[datetime] = None
 
     class Settings:
-        name = "jobs"
\ No newline at end of file
+        name = "cache_entries"
+        indexes = [
+            IndexModel([("namespace", ASCENDING), ("key", ASCENDING)], unique=True),
+            IndexModel([("namespace", ASCENDING), ("created_at", ASCENDING)]),
+            # TTL: Mongo elimina la entrada al llegar a expires_at
+            IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        ]
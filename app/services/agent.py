@@ -6,8 +6,10 @@ Convierte brand guidelines en variaciones creativas usando FIBO
 from openai import AsyncOpenAI
 from app.core.config import settings
 from app.schemas.fibo import BrandGuidelines, BriaParameters, ProposedVariation
-from typing import List
+from app.services.cache import CacheBackend, build_cache, canonical_hash
+from typing import List, Optional
 import json
+import uuid
 import logging
 
 logger = logging.getLogger(__name__)
@@ -25,31 +27,141 @@ def get_openai_client():
     return _openai_client
 
 
+# Memoización de planes LLM: misma campaña + producto + cantidad => mismo plan
+_variations_cache: Optional[CacheBackend] = None
+# Versión (token) por campaña, parte de la clave: invalidar = cambiar el token
+_versions_cache: Optional[CacheBackend] = None
+
+def get_variations_cache() -> CacheBackend:
+    global _variations_cache
+    if _variations_cache is None:
+        _variations_cache = build_cache(
+            "llm_variations",
+            settings.LLM_PLAN_CACHE_BACKEND,
+            ttl=settings.LLM_PLAN_CACHE_TTL_SEC,
+            max_entries=settings.LLM_PLAN_CACHE_MAX_ENTRIES
+        )
+    return _variations_cache
+
+def get_campaign_versions_cache() -> CacheBackend:
+    global _versions_cache
+    if _versions_cache is None:
+        backend = settings.LLM_PLAN_CACHE_BACKEND
+        # La versión se lee siempre del almacenamiento compartido: en "tiered"
+        # una L1 por proceso seguiría sirviendo el token viejo
+        if (backend or "").lower() == "tiered":
+            backend = "mongo"
+        _versions_cache = build_cache(
+            "llm_variations_version",
+            backend,
+            ttl=settings.LLM_PLAN_CACHE_TTL_SEC,
+            max_entries=settings.LLM_PLAN_CACHE_MAX_ENTRIES
+        )
+    return _versions_cache
+
+
+async def _campaign_version(campaign_id: Optional[str]) -> str:
+    """Token vigente de la campaña; si no existe (o expiró) se crea uno nuevo."""
+    if not campaign_id:
+        return ""
+    cache = get_campaign_versions_cache()
+    version = await cache.get(campaign_id)
+    if version is None:
+        version = uuid.uuid4().hex
+        await cache.set(campaign_id, version)
+    return version
+
+
+def _normalize_text(value: Optional[str]) -> str:
+    return " ".join((value or "").split()).lower()
+
+
+def variations_cache_key(
+    brand_guidelines: BrandGuidelines,
+    product_description: str,
+    variations_count: int,
+    campaign_id: Optional[str] = None,
+    version: str = ""
+) -> str:
+    """
+    Hash de la campaña (y su versión), las guidelines normalizadas
+    (espacios/mayúsculas/orden de estilos), producto y cantidad.
+    """
+    return canonical_hash({
+        "campaign_id": campaign_id,
+        "version": version,
+        "primary_color": _normalize_text(brand_guidelines.primary_color),
+        "mood": _normalize_text(brand_guidelines.mood),
+        "target_audience": _normalize_text(brand_guidelines.target_audience),
+        "style_preferences": sorted(_normalize_text(p) for p in (brand_guidelines.style_preferences or [])),
+        "product": _normalize_text(product_description),
+        "count": variations_count,
+    })
 
 
+async def invalidate_campaign_variations(campaign_id: str) -> None:
+    """
+    Descarta los planes memoizados de una campaña (p.ej. al editar sus guidelines).
+    Cambia el token de versión: las entradas viejas quedan inalcanzables y
+    expiran por TTL/LRU. Con backend "memory" solo afecta a este proceso.
+    """
+    await get_campaign_versions_cache().set(campaign_id, uuid.uuid4().hex)
+
 
 async def brand_guidelines_to_variations(
     brand_guidelines: BrandGuidelines,
     product_description: str,
-    variations_count: int = 5
+    variations_count: int = 5,
+    campaign_id: Optional[str] = None,
+    fresh: bool = False
 ) -> List[ProposedVariation]:
     """
     Usa LLM para generar variaciones creativas basadas en brand guidelines
     
+    El resultado se memoiza por guidelines normalizadas + producto + cantidad;
+    `fresh=True` pide una nueva pasada creativa y reemplaza la entrada.
+    
     Args:
         brand_guidelines: Guías de marca (colores, mood, etc.)
         product_description: Descripción del producto
         variations_count: Número de variaciones a generar
+        campaign_id: Campaña dueña del plan (para invalidación)
+        fresh: Ignorar el plan memoizado
     
     Returns:
         Lista de ProposedVariation con parámetros FIBO
     """
     
+    cache = get_variations_cache()
+    version = await _campaign_version(campaign_id)
+    cache_key = variations_cache_key(brand_guidelines, product_description, variations_count, campaign_id, version)
+    if not fresh:
+        cached = await cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Plan LLM servido desde cache ({len(cached)} variaciones)")
+            return [ProposedVariation.model_validate(v) for v in cached]
+    
+    variations = await _llm_variations(brand_guidelines, product_description, variations_count)
+    if variations is None:
+        # Fallback mock: no se memoiza para reintentar el LLM la próxima vez
+        return _generate_mock_variations(brand_guidelines, product_description, variations_count)
+    
+    await cache.set(cache_key, [v.model_dump() for v in variations])
+    return variations
+
+
+async def _llm_variations(
+    brand_guidelines: BrandGuidelines,
+    product_description: str,
+    variations_count: int
+) -> Optional[List[ProposedVariation]]:
+    """Llamada al LLM. Devuelve None si no hay cliente o la llamada falla."""
+    
     client = get_openai_client()
     
     if not client:
         logger.warning("OpenAI API key no configurada, usando variaciones mock")
-        return _generate_mock_variations(brand_guidelines, product_description, variations_count)
+        return None
     
     system_prompt = """
 Eres un AI Art Director de clase mundial y Trend Forecaster.
@@ -150,7 +262,7 @@ Cada variación debe tener un propósito diferente (e.g., hero image, lifestyle
     except Exception as e:
         logger.error(f"Error generando variaciones con LLM: {str(e)}")
         # Fallback a variaciones mock
-        return _generate_mock_variations(brand_guidelines, product_description, variations_count)
+        return None
 
 
 def _generate_mock_variations(
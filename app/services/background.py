@@ -0,0 +1,38 @@
+"""
+Tareas en segundo plano dentro del proceso (espejado, derivados...)
+Mantiene referencias a las tareas para que no las recolecte el GC y permite
+esperarlas de forma acotada al apagar la API o el worker.
+"""
+
+import asyncio
+from typing import Awaitable, Set
+import logging
+
+logger = logging.getLogger(__name__)
+
+_pending: Set[asyncio.Task] = set()
+
+
+def _log_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Tarea en segundo plano falló: {task.exception()!r}")
+
+
+def spawn(coro: Awaitable) -> asyncio.Task:
+    """Lanza la corrutina sin bloquear al llamador."""
+    task = asyncio.ensure_future(coro)
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+    task.add_done_callback(_log_failure)
+    return task
+
+
+async def drain(timeout: float = 30.0) -> None:
+    """Espera las tareas en curso hasta `timeout` segundos y cancela el resto."""
+    if not _pending:
+        return
+    _, still_pending = await asyncio.wait(list(_pending), timeout=timeout)
+    for task in still_pending:
+        task.cancel()
+    # Dejar que corran sus handlers de cancelación antes de cerrar recursos compartidos
+    await asyncio.gather(*still_pending, return_exceptions=True)
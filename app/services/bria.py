@@ -3,10 +3,13 @@ Servicio de integración con Bria AI FIBO
 Maneja la generación de imágenes usando la API de Bria
 """
 
+import asyncio
 import httpx
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, AsyncIterator, Tuple
 from app.core.config import settings
 from app.schemas.fibo import BriaParameters
+from app.services.http_client import get_http_client
+from app.services.cache import CacheBackend, build_cache, canonical_hash
 import logging
 
 logger = logging.getLogger(__name__)
@@ -17,16 +20,36 @@ class BriaAPIError(Exception):
     pass
 
 
+_generation_cache: Optional[CacheBackend] = None
+
+def get_generation_cache() -> CacheBackend:
+    """Cache de resultados FIBO indexada por hash del payload construido."""
+    global _generation_cache
+    if _generation_cache is None:
+        _generation_cache = build_cache(
+            "fibo_generation",
+            settings.GENERATION_CACHE_BACKEND,
+            ttl=settings.GENERATION_CACHE_TTL_SEC,
+            max_entries=settings.GENERATION_CACHE_MAX_ENTRIES
+        )
+    return _generation_cache
+
+
 async def generate_with_fibo(
     bria_params: BriaParameters,
-    mode: str = "generate"
+    mode: str = "generate",
+    use_cache: bool = True
 ) -> Dict[str, Any]:
     """
     Genera imagen usando FIBO de Bria AI
     
+    Con seed fijo el resultado es determinista, así que se sirve desde la
+    cache de generaciones si el mismo payload ya se generó.
+    
     Args:
         bria_params: Parámetros de generación
         mode: Modo de operación ("generate", "refine", "inspire")
+        use_cache: False para forzar una nueva llamada a Bria
     
     Returns:
         Dict con image_url y structured_prompt
@@ -48,30 +71,41 @@ async def generate_with_fibo(
     
     url = f"{settings.BRIA_API_URL}{settings.BRIA_IMAGE_GENERATE_ENDPOINT}"
     
+    cache_key = None
+    if use_cache and payload.get("seed") is not None:
+        cache_key = canonical_hash({"mode": mode, "payload": payload})
+        cached = await get_generation_cache().get(cache_key)
+        if cached is not None:
+            logger.info("Imagen servida desde cache de generaciones")
+            return cached
+    
     try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(url, json=payload, headers=headers)
+        client = get_http_client()
+        response = await client.post(url, json=payload, headers=headers, timeout=120.0)
+        
+        if response.status_code == 200:
+            data = response.json()
+            logger.info("Imagen generada exitosamente")
             
-            if response.status_code == 200:
-                data = response.json()
-                logger.info("Imagen generada exitosamente")
-                
-                # Handle nested 'result' key if present (Common in V2)
-                result_data = data.get("result", data)
-                
-                # V2 uses 'image_url', V1 used 'result_url'
-                img_url = result_data.get("image_url") or result_data.get("result_url")
-                
-                return {
-                    "image_url": img_url,
-                    "structured_prompt": result_data.get("structured_prompt"),
-                    "status": result_data.get("status", "complete")
-                }
-                error_msg = f"Error FIBO API: {response.status_code} - {response.text}"
-                logger.error(error_msg)
-                with open("backend_error.log", "a") as f:
-                    f.write(f"API Error: {error_msg}\n")
-                raise BriaAPIError(error_msg)
+            # Handle nested 'result' key if present (Common in V2)
+            result_data = data.get("result", data)
+            
+            # V2 uses 'image_url', V1 used 'result_url'
+            img_url = result_data.get("image_url") or result_data.get("result_url")
+            
+            result = {
+                "image_url": img_url,
+                "structured_prompt": result_data.get("structured_prompt"),
+                "status": result_data.get("status", "complete")
+            }
+            if cache_key and img_url:
+                await get_generation_cache().set(cache_key, result)
+            return result
+        error_msg = f"Error FIBO API: {response.status_code} - {response.text}"
+        logger.error(error_msg)
+        with open("backend_error.log", "a") as f:
+            f.write(f"API Error: {error_msg}\n")
+        raise BriaAPIError(error_msg)
 
     except httpx.TimeoutException:
         raise BriaAPIError("Timeout al conectar con Bria API")
@@ -130,34 +164,94 @@ def _build_payload(bria_params: BriaParameters, mode: str) -> Dict[str, Any]:
     return payload
 
 
+async def _generate_one(
+    index: int,
+    total: int,
+    params: BriaParameters,
+    mode: str,
+    semaphore: asyncio.Semaphore,
+    use_cache: bool = True
+) -> Tuple[int, Dict[str, Any]]:
+    """Genera una variación respetando el límite de concurrencia del batch."""
+    async with semaphore:
+        try:
+            logger.info(f"Generando variación {index+1}/{total}")
+            result = await generate_with_fibo(params, mode=mode, use_cache=use_cache)
+        except BriaAPIError as e:
+            logger.error(f"Error generando variación {index+1}: {str(e)}")
+            result = {
+                "error": str(e),
+                "image_url": None,
+                "structured_prompt": None
+            }
+    return index, result
+
+
+async def batch_generate_iter(
+    variations: List[BriaParameters],
+    mode: str = "generate",
+    max_concurrency: Optional[int] = None,
+    use_cache: bool = True
+) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Genera múltiples imágenes en paralelo y las entrega a medida que terminan
+    
+    Args:
+        variations: Lista de parámetros para cada variación
+        mode: Modo de generación
+        max_concurrency: Máximo de llamadas simultáneas a Bria
+            (por defecto settings.BRIA_MAX_CONCURRENCY)
+        use_cache: False para ignorar la cache de generaciones
+    
+    Yields:
+        Tuplas (índice, resultado) en orden de finalización. Los errores de
+        Bria se entregan como resultado con la clave "error".
+    """
+    if not variations:
+        return
+    
+    limit = max(1, max_concurrency or settings.BRIA_MAX_CONCURRENCY)
+    semaphore = asyncio.Semaphore(limit)
+    tasks = [
+        asyncio.create_task(_generate_one(i, len(variations), params, mode, semaphore, use_cache))
+        for i, params in enumerate(variations)
+    ]
+    
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Si el consumidor abandona el iterador, no dejar generaciones huérfanas
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
 async def batch_generate(
     variations: List[BriaParameters],
-    mode: str = "generate"
+    mode: str = "generate",
+    max_concurrency: Optional[int] = None,
+    use_cache: bool = True
 ) -> List[Dict[str, Any]]:
     """
-    Genera múltiples imágenes en batch
+    Genera múltiples imágenes en batch (concurrente, con límite)
     
     Args:
         variations: Lista de parámetros para cada variación
         mode: Modo de generación
+        max_concurrency: Máximo de llamadas simultáneas a Bria
+        use_cache: False para ignorar la cache de generaciones
     
     Returns:
-        Lista de resultados con image_url y structured_prompt
+        Lista de resultados con image_url y structured_prompt,
+        en el mismo orden que `variations`
     """
-    results = []
+    results: List[Dict[str, Any]] = [{} for _ in variations]
     
-    for i, params in enumerate(variations):
-        try:
-            logger.info(f"Generando variación {i+1}/{len(variations)}")
-            result = await generate_with_fibo(params, mode=mode)
-            results.append(result)
-        except BriaAPIError as e:
-            logger.error(f"Error generando variación {i+1}: {str(e)}")
-            results.append({
-                "error": str(e),
-                "image_url": None,
-                "structured_prompt": None
-            })
+    async for index, result in batch_generate_iter(
+        variations, mode=mode, max_concurrency=max_concurrency, use_cache=use_cache
+    ):
+        results[index] = result
     
     return results
 
@@ -189,13 +283,13 @@ async def generate_structured_prompt(prompt: str) -> Dict[str, Any]:
     url = f"{settings.BRIA_API_URL}{settings.BRIA_STRUCTURED_PROMPT_ENDPOINT}"
     
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(url, json=payload, headers=headers)
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise BriaAPIError(f"Error generando structured_prompt: {response.text}")
+        client = get_http_client()
+        response = await client.post(url, json=payload, headers=headers, timeout=60.0)
+        
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise BriaAPIError(f"Error generando structured_prompt: {response.text}")
                 
     except httpx.RequestError as e:
         raise BriaAPIError(f"Error de conexión: {str(e)}")
@@ -0,0 +1,217 @@
+"""
+Poller central para los status_url de Bria v2
+En lugar de un loop de polling por request, todos los jobs pendientes se
+registran aquí: un único scheduler reparte los GET en el tiempo (con jitter),
+reutiliza el pool HTTP compartido y resuelve un future por status_url.
+"""
+
+import asyncio
+import heapq
+import itertools
+import random
+from typing import Dict, Any, List, Optional, Tuple
+from fastapi import HTTPException
+from app.core.config import settings
+from app.services.bria_v2 import BriaV2Client
+import logging
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("COMPLETED", "ERROR", "UNKNOWN", "FAILED")
+
+
+class _PollEntry:
+    """Estado de polling de un status_url registrado."""
+
+    def __init__(self, status_url: str, future: asyncio.Future, deadline: float, delay: float, generation: int):
+        self.status_url = status_url
+        self.future = future
+        self.deadline = deadline
+        self.delay = delay
+        self.generation = generation  # Distingue re-registros del mismo status_url
+        self.waiters = 0
+
+
+class BriaStatusPoller:
+    """
+    Scheduler único de polls contra Bria.
+    `register()` devuelve un future que se resuelve con la respuesta final
+    del status_url (status COMPLETED/ERROR/FAILED/UNKNOWN).
+    """
+
+    def __init__(
+        self,
+        client: Optional[BriaV2Client] = None,
+        max_in_flight: Optional[int] = None,
+        jitter: Optional[float] = None
+    ):
+        self.client = client or BriaV2Client()
+        self.max_in_flight = max_in_flight or settings.BRIA_POLL_MAX_IN_FLIGHT
+        self.jitter = settings.BRIA_POLL_JITTER if jitter is None else jitter
+        
+        self._entries: Dict[str, _PollEntry] = {}
+        # (due, desempate, status_url, generación de la entrada que lo programó)
+        self._heap: List[Tuple[float, int, str, int]] = []
+        self._counter = itertools.count()
+        self._generations = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight: set = set()
+
+    # ------------------------------------------------------------------
+    # API pública
+    # ------------------------------------------------------------------
+
+    def register(self, status_url: str, timeout: Optional[float] = None) -> asyncio.Future:
+        """Registra un status_url y devuelve su future (compartido si ya estaba registrado)."""
+        self._ensure_started()
+        entry = self._entries.get(status_url)
+        if entry is not None and not entry.future.done():
+            return entry.future
+        
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout if timeout is not None else self.client.timeout_sec)
+        entry = _PollEntry(
+            status_url, loop.create_future(), deadline, self.client.poll_min_sec, next(self._generations)
+        )
+        self._entries[status_url] = entry
+        # Primer poll repartido dentro de la ventana inicial para evitar ráfagas
+        self._schedule(entry, loop.time() + entry.delay * random.uniform(0.5, 1.0 + self.jitter))
+        return entry.future
+
+    async def wait(self, status_url: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Registra y espera el resultado. Cancelar al último waiter libera la entrada."""
+        future = self.register(status_url, timeout=timeout)
+        entry = self._entries[status_url]
+        entry.waiters += 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.done() and entry.waiters <= 1:
+                future.cancel()
+            raise
+        finally:
+            entry.waiters -= 1
+
+    @property
+    def pending(self) -> int:
+        return len(self._entries)
+
+    async def stop(self) -> None:
+        """Detiene el scheduler y cancela los futures pendientes."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._in_flight):
+            task.cancel()
+        for entry in self._entries.values():
+            if not entry.future.done():
+                entry.future.cancel()
+        self._entries.clear()
+        self._heap.clear()
+
+    # ------------------------------------------------------------------
+    # Scheduler interno
+    # ------------------------------------------------------------------
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._task = asyncio.create_task(self._run())
+
+    def _schedule(self, entry: _PollEntry, due: float) -> None:
+        heapq.heappush(self._heap, (due, next(self._counter), entry.status_url, entry.generation))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        assert self._wakeup is not None and self._semaphore is not None
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+            
+            while self._heap and self._heap[0][0] <= now:
+                _, _, status_url, generation = heapq.heappop(self._heap)
+                entry = self._entries.get(status_url)
+                if entry is None or entry.generation != generation:
+                    # Programado por una entrada anterior del mismo status_url
+                    continue
+                if entry.future.done():
+                    # Cancelado por sus waiters o ya resuelto
+                    self._entries.pop(status_url, None)
+                    continue
+                await self._semaphore.acquire()
+                task = asyncio.create_task(self._check(entry))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+            
+            timeout = (self._heap[0][0] - loop.time()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, entry: _PollEntry) -> None:
+        loop = asyncio.get_running_loop()
+        assert self._semaphore is not None
+        try:
+            # El GET no puede pasarse del deadline de la entrada
+            remaining = max(entry.deadline - loop.time(), 0.0)
+            data = await self.client._aget(entry.status_url, timeout=min(remaining, self.client.timeout_sec))
+        except HTTPException as e:
+            if e.status_code < 500:
+                self._finish(entry, exc=e)
+                return
+            # Errores transitorios (5xx / conexión): reintentar hasta el deadline
+            logger.warning(f"Poll transitorio fallido para {entry.status_url}: {e.detail}")
+            data = None
+        except Exception as e:
+            self._finish(entry, exc=e)
+            return
+        finally:
+            self._semaphore.release()
+        
+        if data is not None and (data.get("status") or "").upper() in TERMINAL_STATUSES:
+            self._finish(entry, result=data)
+            return
+        
+        if loop.time() >= entry.deadline:
+            self._finish(entry, exc=HTTPException(status_code=504, detail="Timeout esperando Bria status."))
+            return
+        
+        entry.delay = min(entry.delay * self.client.poll_backoff, self.client.poll_max_sec)
+        spread = entry.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self._schedule(entry, min(loop.time() + spread, entry.deadline))
+
+    def _finish(self, entry: _PollEntry, result: Optional[Dict[str, Any]] = None, exc: Optional[BaseException] = None) -> None:
+        if self._entries.get(entry.status_url) is entry:
+            self._entries.pop(entry.status_url, None)
+        if entry.future.done():
+            return
+        if exc is not None:
+            entry.future.set_exception(exc)
+        else:
+            entry.future.set_result(result)
+
+
+# Singleton instance
+_poller: Optional[BriaStatusPoller] = None
+
+def get_status_poller() -> BriaStatusPoller:
+    global _poller
+    if _poller is None:
+        _poller = BriaStatusPoller()
+    return _poller
+
+async def shutdown_status_poller() -> None:
+    global _poller
+    if _poller is not None:
+        await _poller.stop()
+        _poller = None
@@ -1,8 +1,9 @@
-import time
-import requests
+import asyncio
+import httpx
 from typing import Dict, Any, Optional, List
 from fastapi import HTTPException
 from app.core.config import settings
+from app.services.http_client import get_http_client
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,44 +17,53 @@ class BriaV2Client:
         self.base_url = "https://engine.prod.bria-api.com/v2"  # Hardcoded default or from settings
         self.api_token = settings.BRIA_API_KEY
         self.timeout_sec = float(getattr(settings, 'DEFAULT_TIMEOUT_SEC', 300))
-        self.poll_every_sec = float(getattr(settings, 'DEFAULT_POLL_EVERY_SEC', 2))
+        self.poll_min_sec = float(getattr(settings, 'BRIA_POLL_MIN_SEC', 0.5))
+        self.poll_max_sec = float(getattr(settings, 'BRIA_POLL_MAX_SEC', 5))
+        self.poll_backoff = float(getattr(settings, 'BRIA_POLL_BACKOFF', 1.5))
         
-        self.session = requests.Session()
-        self.session.headers.update({"api_token": self.api_token})
+        self.headers = {"api_token": self.api_token}
 
-    def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-        url = self.base_url.rstrip("/") + "/" + path.lstrip("/")
+    def _url(self, path: str) -> str:
+        return self.base_url.rstrip("/") + "/" + path.lstrip("/")
+
+    async def _apost(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST a Bria sobre el cliente HTTP compartido (keep-alive)."""
         try:
-            r = self.session.post(url, json=payload, timeout=self.timeout_sec)
-            if r.status_code not in (200, 202):
-                logger.error(f"Bria API Error ({r.status_code}): {r.text}")
-                raise HTTPException(status_code=r.status_code, detail=r.text)
-            return r.json()
-        except requests.exceptions.RequestException as e:
+            r = await get_http_client().post(
+                self._url(path), json=payload, headers=self.headers, timeout=self.timeout_sec
+            )
+        except httpx.RequestError as e:
             logger.error(f"Bria Request Failed: {e}")
             raise HTTPException(status_code=503, detail=f"Bria API connection failed: {str(e)}")
+        if r.status_code not in (200, 202):
+            logger.error(f"Bria API Error ({r.status_code}): {r.text}")
+            raise HTTPException(status_code=r.status_code, detail=r.text)
+        return r.json()
 
-    def _get(self, url: str) -> Dict[str, Any]:
+    async def _aget(self, url: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """GET a Bria sobre el cliente HTTP compartido (keep-alive)."""
         try:
-            r = self.session.get(url, timeout=self.timeout_sec)
-            if r.status_code != 200:
-                logger.error(f"Bria API Error ({r.status_code}): {r.text}")
-                raise HTTPException(status_code=r.status_code, detail=r.text)
-            return r.json()
-        except requests.exceptions.RequestException as e:
+            r = await get_http_client().get(
+                url, headers=self.headers, timeout=self.timeout_sec if timeout is None else timeout
+            )
+        except httpx.RequestError as e:
             logger.error(f"Bria Request Failed: {e}")
             raise HTTPException(status_code=503, detail=f"Bria API connection failed: {str(e)}")
+        if r.status_code != 200:
+            logger.error(f"Bria API Error ({r.status_code}): {r.text}")
+            raise HTTPException(status_code=r.status_code, detail=r.text)
+        return r.json()
 
-    def structured_prompt_generate(self, prompt: str, image_b64: str) -> Dict[str, Any]:
+    async def astructured_prompt_generate(self, prompt: str, image_b64: str) -> Dict[str, Any]:
         """Genera un structured prompt a partir de un texto y una imagen."""
         payload = {
-            "prompt": prompt, 
-            "images": [image_b64], 
+            "prompt": prompt,
+            "images": [image_b64],
             "sync": False
         }
-        return self._post("/structured_prompt/generate", payload)
+        return await self._apost("/structured_prompt/generate", payload)
 
-    def image_generate(self, structured_prompt: str, seed: Optional[int], aspect_ratio: str) -> Dict[str, Any]:
+    async def aimage_generate(self, structured_prompt: str, seed: Optional[int], aspect_ratio: str) -> Dict[str, Any]:
         """Genera una imagen usando un structured prompt."""
         body: Dict[str, Any] = {
             "structured_prompt": structured_prompt,
@@ -64,23 +74,36 @@ class BriaV2Client:
         }
         if seed is not None:
             body["seed"] = int(seed)
-        return self._post("/image/generate", body)
+        return await self._apost("/image/generate", body)
 
-    def poll_until_done(self, status_url: str) -> Dict[str, Any]:
-        """Hacer polling a un job asíncrono hasta que termine."""
-        t0 = time.time()
+    async def apoll_until_done(self, status_url: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Polling async hasta que el job termine.
+        Empieza con polls rápidos (poll_min_sec) y los espacia con backoff
+        hasta poll_max_sec. `timeout` es el deadline de esta llamada
+        (por defecto timeout_sec); cada GET se acota a lo que queda de él.
+        Cancelar la tarea detiene el polling.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout if timeout is not None else self.timeout_sec)
+        delay = self.poll_min_sec
         while True:
-            if time.time() - t0 > self.timeout_sec:
-                raise HTTPException(status_code=504, detail="Timeout esperando Bria status.")
-            
-            data = self._get(status_url)
+            remaining = deadline - loop.time()
+            try:
+                data = await self._aget(status_url, timeout=min(max(remaining, 0.0), self.timeout_sec))
+            except HTTPException as e:
+                if e.status_code == 503 and loop.time() >= deadline:
+                    # El GET se cortó por el deadline de la llamada
+                    raise HTTPException(status_code=504, detail="Timeout esperando Bria status.") from None
+                raise
             st = (data.get("status") or "").upper()
             
             if st in ("COMPLETED", "ERROR", "UNKNOWN", "FAILED"):
                 return data
             
-            # Si responde con error explícito
-            if st == "FAILED":
-                 raise HTTPException(status_code=502, detail=f"Bria job failed: {data}")
-
-            time.sleep(self.poll_every_sec)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise HTTPException(status_code=504, detail="Timeout esperando Bria status.")
+            
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * self.poll_backoff, self.poll_max_sec)
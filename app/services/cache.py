@@ -0,0 +1,243 @@
+"""
+Caches reutilizables (generaciones FIBO, structured prompts, planes LLM...)
+Backends intercambiables con la misma interfaz async:
+- MemoryLRUCache: LRU en proceso con TTL y límite de entradas
+- MongoCache: colección `cache_entries` con índice TTL (compartida entre procesos)
+- TieredCache: memoria como L1 delante de Mongo como L2
+"""
+
+import copy
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+from app.schemas.fibo import CacheEntry
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def canonical_hash(obj: Any) -> str:
+    """SHA-256 de la serialización JSON canónica (claves ordenadas, sin espacios)."""
+    raw = json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CacheBackend:
+    """Interfaz común. Los valores deben ser serializables a JSON/BSON."""
+
+    def __init__(self, namespace: str, ttl: Optional[float] = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def clear(self) -> None:
+        raise NotImplementedError
+
+    def _record(self, value: Optional[Any]) -> Optional[Any]:
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+class MemoryLRUCache(CacheBackend):
+    """LRU en memoria del proceso; expira por TTL y expulsa por tamaño."""
+
+    def __init__(self, namespace: str, max_entries: int = 1000, ttl: Optional[float] = None):
+        super().__init__(namespace, ttl)
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[Optional[float], Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_nowait(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return self._record(None)
+        expires_at, value = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            return self._record(None)
+        self._data.move_to_end(key)
+        # Copia para que el llamador no mute la entrada cacheada
+        return self._record(copy.deepcopy(value))
+
+    def set_nowait(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._data[key] = (expires_at, copy.deepcopy(value))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.get_nowait(key)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self.set_nowait(key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "size": len(self._data), "max_entries": self.max_entries}
+
+
+def _as_utc(value: datetime) -> datetime:
+    """PyMongo devuelve los datetime naive (en UTC)."""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+class MongoCache(CacheBackend):
+    """
+    Cache persistente en la colección `cache_entries`.
+    La expiración la aplica el índice TTL de MongoDB; el límite de tamaño se
+    revisa cada `trim_every` escrituras eliminando las entradas más antiguas.
+    """
+
+    def __init__(self, namespace: str, max_entries: Optional[int] = None, ttl: Optional[float] = None, trim_every: int = 100):
+        super().__init__(namespace, ttl)
+        self.max_entries = max_entries
+        self.trim_every = trim_every
+        self._writes = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        try:
+            entry = await CacheEntry.find_one(CacheEntry.namespace == self.namespace, CacheEntry.key == key)
+        except Exception as e:
+            logger.warning(f"Cache Mongo no disponible ({self.namespace}): {e}")
+            return self._record(None)
+        # El monitor TTL de Mongo corre cada ~60s: filtrar lo ya vencido
+        if entry is None or (entry.expires_at and _as_utc(entry.expires_at) <= datetime.now(timezone.utc)):
+            return self._record(None)
+        return self._record(entry.value)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        # En UTC: Mongo guarda los datetime naive como UTC y el monitor TTL compara en UTC
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=ttl) if ttl else None
+        try:
+            await CacheEntry.find_one(CacheEntry.namespace == self.namespace, CacheEntry.key == key).upsert(
+                {"$set": {"value": value, "expires_at": expires_at, "created_at": now}},
+                on_insert=CacheEntry(
+                    namespace=self.namespace, key=key, value=value, expires_at=expires_at, created_at=now
+                ),
+            )
+        except Exception as e:
+            logger.warning(f"No se pudo escribir en cache Mongo ({self.namespace}): {e}")
+            return
+        self._writes += 1
+        if self.max_entries and self._writes % self.trim_every == 0:
+            try:
+                await self._trim()
+            except Exception as e:
+                # El valor ya quedó escrito: un trim fallido se reintenta en el próximo ciclo
+                logger.warning(f"No se pudo recortar la cache Mongo ({self.namespace}): {e}")
+
+    async def delete(self, key: str) -> None:
+        try:
+            await CacheEntry.find(CacheEntry.namespace == self.namespace, CacheEntry.key == key).delete()
+        except Exception as e:
+            logger.warning(f"No se pudo borrar de la cache Mongo ({self.namespace}): {e}")
+
+    async def clear(self) -> None:
+        try:
+            await CacheEntry.find(CacheEntry.namespace == self.namespace).delete()
+        except Exception as e:
+            logger.warning(f"No se pudo vaciar la cache Mongo ({self.namespace}): {e}")
+
+    async def _trim(self) -> None:
+        total = await CacheEntry.find(CacheEntry.namespace == self.namespace).count()
+        surplus = total - (self.max_entries or total)
+        if surplus <= 0:
+            return
+        oldest = await CacheEntry.find(CacheEntry.namespace == self.namespace).sort("+created_at").limit(surplus).to_list()
+        await CacheEntry.find({"_id": {"$in": [e.id for e in oldest]}}).delete()
+
+
+class TieredCache(CacheBackend):
+    """L1 en memoria + L2 en Mongo. Los hits de L2 se promueven a L1."""
+
+    def __init__(self, namespace: str, max_entries: int = 1000, ttl: Optional[float] = None):
+        super().__init__(namespace, ttl)
+        self.l1 = MemoryLRUCache(namespace, max_entries=max_entries, ttl=ttl)
+        self.l2 = MongoCache(namespace, max_entries=max_entries * 10, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self.l1.get(key)
+        if value is None:
+            value = await self.l2.get(key)
+            if value is not None:
+                await self.l1.set(key, value)
+        return self._record(value)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await self.l1.set(key, value, ttl)
+        await self.l2.set(key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self.l1.delete(key)
+        await self.l2.delete(key)
+
+    async def clear(self) -> None:
+        await self.l1.clear()
+        await self.l2.clear()
+
+
+class NullCache(CacheBackend):
+    """Cache deshabilitada (backend "none")."""
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self._record(None)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        return None
+
+    async def delete(self, key: str) -> None:
+        return None
+
+    async def clear(self) -> None:
+        return None
+
+
+def build_cache(namespace: str, backend: str, ttl: Optional[float] = None, max_entries: int = 1000) -> CacheBackend:
+    """Crea el backend indicado por configuración ("memory", "mongo", "tiered" o "none")."""
+    backend = (backend or "memory").lower()
+    if backend == "none":
+        return NullCache(namespace, ttl)
+    if backend == "mongo":
+        return MongoCache(namespace, max_entries=max_entries, ttl=ttl)
+    if backend == "tiered":
+        return TieredCache(namespace, max_entries=max_entries, ttl=ttl)
+    if backend != "memory":
+        logger.warning(f"Backend de cache desconocido '{backend}', usando memoria")
+    return MemoryLRUCache(namespace, max_entries=max_entries, ttl=ttl)
@@ -0,0 +1,154 @@
+"""
+Derivados responsivos (miniaturas) de imágenes guardadas
+Cada imagen del bucket (resultado espejado o producto subido) se reduce a
+varios tamaños en formato comprimido moderno. El redimensionado corre en un
+ProcessPoolExecutor, fuera del event loop y del request.
+"""
+
+import asyncio
+import hashlib
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+from app.core.config import settings
+from app.schemas.fibo import Product, StoredImage
+from app.services import background, storage
+from app.services.http_client import get_http_client
+from app.services.images import pillow_available, render_derivatives
+import logging
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # "spawn": el pool se crea con el servidor ya corriendo (hilos de boto3,
+        # pymongo...) y hacer fork de un proceso con hilos puede colgar al hijo
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.DERIVATIVE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+def shutdown_process_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def derivative_sizes() -> List[int]:
+    return [int(s) for s in settings.DERIVATIVE_SIZES.split(",") if s.strip()]
+
+
+def enabled() -> bool:
+    return settings.DERIVATIVES_ENABLED and pillow_available()
+
+
+async def create_derivatives(data: bytes, user_id: str, sha256: str) -> Dict[str, str]:
+    """Renderiza en el process pool y sube cada tamaño. Devuelve {"256": url, ...}."""
+    fmt = settings.DERIVATIVE_FORMAT.upper()
+    loop = asyncio.get_running_loop()
+    rendered = await loop.run_in_executor(
+        get_process_pool(), render_derivatives, data, derivative_sizes(), fmt, settings.DERIVATIVE_QUALITY
+    )
+    
+    ext = fmt.lower()
+    urls: Dict[str, str] = {}
+    for size, blob in rendered.items():
+        key = f"{user_id}/derivatives/{sha256}_{size}.{ext}"
+        urls[str(size)] = await storage.upload_fileobj(io.BytesIO(blob), key, f"image/{ext}")
+    return urls
+
+
+async def ensure_derivatives(stored: StoredImage, data: Optional[bytes] = None) -> Dict[str, str]:
+    """Derivados de una imagen del índice; se generan una sola vez por contenido."""
+    if stored.derivatives:
+        return stored.derivatives
+    if not enabled():
+        return {}
+    
+    if data is None:
+        response = await get_http_client().get(stored.url, timeout=60.0)
+        response.raise_for_status()
+        data = response.content
+    
+    urls = await create_derivatives(data, stored.user_id, stored.sha256)
+    if urls:
+        await StoredImage.find_one(StoredImage.id == stored.id).update({"$set": {"derivatives": urls}})
+        stored.derivatives = urls
+    return urls
+
+
+async def derive_product(product_id: str, stored: Optional[StoredImage] = None) -> None:
+    """Genera y guarda los derivados de la imagen de un producto."""
+    product = await Product.get(product_id)
+    if not product:
+        return
+    
+    if stored is None:
+        # Producto sin registro en el índice: identificar por contenido
+        response = await get_http_client().get(product.image_url, timeout=60.0)
+        response.raise_for_status()
+        data = response.content
+        sha256 = hashlib.sha256(data).hexdigest()
+        urls = await create_derivatives(data, product.user_id, sha256)
+        update = {"derivative_urls": urls, "content_hash": product.content_hash or sha256}
+    else:
+        urls = await ensure_derivatives(stored)
+        update = {"derivative_urls": urls}
+    
+    if urls:
+        await Product.find_one(Product.id == product.id).update({"$set": update})
+        logger.info(f"Producto {product_id}: {len(urls)} derivados generados")
+
+
+async def index_product_upload(product_id: str) -> None:
+    """
+    Registra en el índice la imagen de una subida directa (presigned) y la
+    deduplica por contenido: si el usuario ya la tenía, el producto apunta a
+    la existente y se borra la copia nueva. Luego genera los derivados.
+    """
+    product = await Product.get(product_id)
+    if not product or not product.storage_key or product.content_hash:
+        return
+    
+    response = await get_http_client().get(product.image_url, timeout=60.0)
+    response.raise_for_status()
+    data = response.content
+    stored = await storage.register_stored(
+        product.user_id,
+        hashlib.sha256(data).hexdigest(),
+        product.storage_key,
+        len(data),
+        response.headers.get("content-type")
+    )
+    
+    update = {"content_hash": stored.sha256, "image_url": stored.url}
+    if stored.derivatives:
+        update["derivative_urls"] = stored.derivatives
+    await Product.find_one(Product.id == product.id).update({"$set": update})
+    if stored.key != product.storage_key:
+        await storage.delete_object(product.storage_key)
+    
+    if enabled() and not stored.derivatives:
+        urls = await ensure_derivatives(stored, data)
+        if urls:
+            await Product.find_one(Product.id == product.id).update({"$set": {"derivative_urls": urls}})
+            logger.info(f"Producto {product_id}: {len(urls)} derivados generados")
+
+
+def schedule_product_upload(product_id: str) -> None:
+    """Lanza el registro (hash + deduplicación) de una subida directa en segundo plano."""
+    background.spawn(index_product_upload(product_id))
+
+
+def schedule_product(product_id: str, stored: Optional[StoredImage] = None) -> None:
+    """Lanza la generación de derivados del producto en segundo plano."""
+    if enabled():
+        background.spawn(derive_product(product_id, stored))
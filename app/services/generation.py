@@ -0,0 +1,112 @@
+"""
+Pipeline de generación del Playground (/generate-async)
+Lo ejecutan tanto el web worker (modo background) como los workers de la
+cola (app/worker.py); todo el contexto se lee del documento Job.
+"""
+
+import json
+from typing import List, Optional
+from app.schemas.fibo import Job, Plan, BriaParameters, ProposedVariation
+from app.services.bria import generate_with_fibo
+from app.services import jobs, mirror, prompt_patch
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def run_generation_job(job: Job, worker_id: Optional[str] = None) -> List[str]:
+    """
+    Genera las variaciones de un job y persiste el Plan en el historial.
+    Lanza excepción si no se pudo generar ninguna imagen (la cola decide
+    si reintenta o marca el job como fallido). Con `worker_id`, el cierre
+    solo se aplica si el lease sigue siendo de ese worker.
+    """
+    job_id = job.job_id
+    prompt = job.prompt
+    image_url = job.image_path
+    variations = job.variations
+    brand_guidelines = job.brand_guidelines
+    user_id = job.user_id
+    aspect_ratio = job.aspect_ratio or "1:1"
+    
+    await jobs.update_job(job_id, stage=jobs.JobStage.STARTED, progress=10)
+    
+    results = []
+    proposed_vars = [] # To save in Plan
+    
+    effective_prompt = prompt
+    if brand_guidelines:
+        effective_prompt = f"{prompt}. Context: {brand_guidelines}"
+    
+    for i in range(variations):
+        progress_step = 10 + int((i / variations) * 80)
+        await jobs.update_job(job_id, progress=progress_step)
+        await jobs.add_event(job_id, f"Generating variation {i+1}/{variations}...")
+        
+        mode = "inspire" if image_url else "generate"
+        
+        params = BriaParameters(
+            prompt=effective_prompt,
+            reference_image_url=image_url,
+            camera_angle="eye_level",
+            seed=None,
+            aspect_ratio=aspect_ratio
+        )
+        
+        try:
+            res = await generate_with_fibo(params, mode=mode)
+            
+            if res.get("image_url"):
+                img_url = res["image_url"]
+                await jobs.add_result(job_id, img_url)
+                results.append(img_url)
+                
+                # Handle SP format
+                sp = res.get("structured_prompt", {})
+                if isinstance(sp, str):
+                    try:
+                        sp = json.loads(sp)
+                    except json.JSONDecodeError:
+                        sp = {}
+                        
+                # Add to proposed vars for persistence
+                proposed_vars.append(ProposedVariation(
+                    concept_name=f"Quick Gen {i+1}",
+                    bria_parameters=params,
+                    generated_image_url=img_url,
+                    json_prompt=sp
+                ))
+                
+        except Exception as e:
+            logger.error(f"Error generating variation {i}: {e}")
+            await jobs.add_event(job_id, f"Error on var {i+1}: {str(e)}")
+    
+    if not results:
+         raise Exception("No images could be generated.")
+
+    if not await jobs.complete_job(job_id, results, worker_id=worker_id):
+        # Otro worker retomó el job: su ejecución es la que cuenta
+        return results
+    
+    # PERSIST TO MONGODB (PLAN HISTORY)
+    if user_id and proposed_vars:
+        try:
+            new_plan = Plan(
+                campaign_id="playground",  # Generic campaign
+                product_id="direct_upload",
+                proposed_variations=proposed_vars,
+                status="completed",
+                user_id=user_id,
+                job_id=job_id
+            )
+            # Base + patch por variación en vez de N prompts casi idénticos
+            prompt_patch.compact_plan(new_plan)
+            mirror.mark_pending(new_plan)
+            await new_plan.insert()
+            logger.info(f"Persisted job {job_id} as Plan {new_plan.id} for user {user_id}")
+            # Copiar los resultados a nuestro bucket antes de que expiren
+            mirror.schedule(mirror.mirror_plan(str(new_plan.id), job_id=job_id))
+        except Exception as db_e:
+            logger.exception(f"Failed to persist plan to MongoDB: {db_e}")
+    
+    return results
@@ -0,0 +1,53 @@
+"""
+Cliente HTTP compartido para el tráfico saliente (Bria, descargas)
+Un único httpx.AsyncClient con keep-alive y pool de conexiones por proceso,
+gestionado desde el lifespan de la aplicación.
+"""
+
+import httpx
+from typing import Optional
+from app.core.config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    """HTTP/2 requiere el paquete opcional `h2` (httpx[http2])."""
+    if not settings.HTTP_ENABLE_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _build_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=settings.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY_SEC,
+    )
+    timeout = httpx.Timeout(settings.HTTP_TIMEOUT_SEC, connect=settings.HTTP_CONNECT_TIMEOUT_SEC)
+    http2 = _http2_available()
+    logger.info(f"Cliente HTTP compartido inicializado (http2={http2}, max_connections={settings.HTTP_MAX_CONNECTIONS})")
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Devuelve el cliente compartido, creándolo si aún no existe."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+
+async def close_http_client() -> None:
+    """Cierra el pool de conexiones (llamado en el shutdown del lifespan)."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,92 @@
+"""
+Procesamiento de imágenes con Pillow
+Pillow es una dependencia opcional: si no está instalada, las imágenes se
+usan tal cual.
+"""
+
+import io
+from typing import Dict, List, Optional
+from app.core.config import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - depende del entorno
+    Image = None
+    ImageOps = None
+
+
+def pillow_available() -> bool:
+    return Image is not None
+
+
+def preprocess_reference_image(
+    data: bytes,
+    max_edge: Optional[int] = None,
+    fmt: Optional[str] = None,
+    quality: Optional[int] = None
+) -> bytes:
+    """
+    Prepara una imagen de referencia para enviarla a Bria:
+    corrige la orientación EXIF, reduce el lado mayor a `max_edge`,
+    re-codifica en `fmt` y descarta la metadata (EXIF, ICC, XMP).
+    Si no hay Pillow, la imagen es ilegible o el resultado no es más
+    liviano que el original (sin reducción), devuelve los bytes originales.
+    """
+    if not pillow_available():
+        return data
+    
+    max_edge = max_edge or settings.IMAGE_PREPROCESS_MAX_EDGE
+    fmt = (fmt or settings.IMAGE_PREPROCESS_FORMAT).upper()
+    quality = quality or settings.IMAGE_PREPROCESS_QUALITY
+    
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            resized = max(img.size) > max_edge
+            if resized:
+                img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            
+            if fmt == "JPEG":
+                img = img.convert("RGB")
+            elif img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+            
+            out = io.BytesIO()
+            # Sin exif/icc_profile => metadata descartada
+            img.save(out, format=fmt, quality=quality, optimize=True)
+            processed = out.getvalue()
+    except Exception as e:
+        logger.warning(f"No se pudo preprocesar la imagen, se usa el original: {e}")
+        return data
+    
+    if not resized and len(processed) >= len(data):
+        return data
+    return processed
+
+
+def render_derivatives(data: bytes, sizes: List[int], fmt: str = "WEBP", quality: int = 80) -> Dict[int, bytes]:
+    """
+    Genera versiones reducidas (lado mayor = size) de una imagen.
+    Pensada para ejecutarse en un ProcessPoolExecutor (CPU-bound, picklable).
+    Los tamaños mayores que el original se omiten.
+    """
+    if not pillow_available():
+        return {}
+    
+    out: Dict[int, bytes] = {}
+    with Image.open(io.BytesIO(data)) as src:
+        src = ImageOps.exif_transpose(src)
+        if src.mode not in ("RGB", "RGBA"):
+            src = src.convert("RGBA" if "A" in src.getbands() else "RGB")
+        for size in sorted(sizes, reverse=True):
+            if size >= max(src.size):
+                continue
+            img = src.copy()
+            img.thumbnail((size, size), Image.Resampling.LANCZOS)
+            buf = io.BytesIO()
+            img.save(buf, format=fmt.upper(), quality=quality, method=4)
+            out[size] = buf.getvalue()
+    return out
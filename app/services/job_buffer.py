@@ -0,0 +1,224 @@
+"""
+Buffer write-behind para la telemetría de jobs
+Agrupa por job los cambios de progreso/etapa y los eventos, y los escribe en
+MongoDB cada `flush_interval` segundos o cuando el job llega a una etapa
+terminal: un $set sobre el job y un insert_many append-only en job_events.
+"""
+
+import asyncio
+import time
+import weakref
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
+from pymongo import ReturnDocument
+from app.core.config import settings
+from app.core.db import get_collection
+from app.schemas.fibo import Job, JobEvent
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Máximo de eventos devueltos al leer el estado de un job
+MAX_EVENTS = 250
+
+
+def retention_expires_at() -> Optional[datetime]:
+    """Fecha de expiración en UTC (índices TTL) para jobs terminados y sus eventos."""
+    if settings.JOB_TTL_SEC <= 0:
+        return None
+    return datetime.now(timezone.utc) + timedelta(seconds=settings.JOB_TTL_SEC)
+
+
+# Un lock por job: reservar secuencia y escribir van juntos, para que un
+# lector nunca vea el seq N+1 persistido antes que el N (mismo proceso; entre
+# procesos, solo el dueño del lease escribe telemetría)
+_seq_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def telemetry_lock(job_id: str) -> asyncio.Lock:
+    lock = _seq_locks.get(job_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _seq_locks[job_id] = lock
+    return lock
+
+
+# Dueño del lease (worker_id) de los jobs que ejecuta este proceso: la
+# telemetría solo se escribe mientras el job le siga perteneciendo
+_owners: Dict[str, str] = {}
+
+def set_owner(job_id: str, worker_id: str) -> None:
+    _owners[job_id] = worker_id
+
+def release_owner(job_id: str, worker_id: str) -> None:
+    if _owners.get(job_id) == worker_id:
+        _owners.pop(job_id, None)
+
+def owner_filter(job_id: str, owner: Optional[str] = None) -> Dict[str, Any]:
+    """Filtro del job, condicionado al lease si este proceso lo ejecuta."""
+    query: Dict[str, Any] = {"job_id": job_id}
+    owner = owner or _owners.get(job_id)
+    if owner:
+        query["worker_id"] = owner
+    return query
+
+
+async def reserve_seq(job_id: str, count: int = 1, owner: Optional[str] = None) -> Optional[int]:
+    """Reserva `count` números de Job.event_seq y devuelve el primero (None si el job ya no es nuestro)."""
+    doc = await get_collection(Job).find_one_and_update(
+        owner_filter(job_id, owner),
+        {"$inc": {"event_seq": count}},
+        projection={"event_seq": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is None:
+        return None
+    return doc["event_seq"] - count + 1
+
+
+async def insert_events(job_id: str, events: List[Dict[str, Any]], owner: Optional[str] = None) -> bool:
+    """
+    Inserta eventos en job_events con seq consecutivos; el job solo incrementa
+    event_seq. False (sin escribir) si el job ya no pertenece a `owner`.
+    """
+    expires_at = retention_expires_at()
+    async with telemetry_lock(job_id):
+        first = await reserve_seq(job_id, len(events), owner)
+        if first is None:
+            return False
+        await JobEvent.insert_many([
+            JobEvent(job_id=job_id, seq=first + i, t=e["t"], msg=e["msg"], expires_at=expires_at)
+            for i, e in enumerate(events)
+        ])
+    return True
+
+
+class _PendingJob:
+    """Cambios aún no persistidos de un job (y el lease bajo el que se produjeron)."""
+
+    def __init__(self, owner: Optional[str] = None):
+        self.owner = owner
+        self.fields: Dict[str, Any] = {}
+        self.events: List[Dict[str, Any]] = []
+
+
+class JobTelemetryBuffer:
+    """
+    Coalesce updates de jobs en memoria del proceso.
+    Si flush_interval <= 0 se comporta como write-through.
+    """
+
+    def __init__(self, flush_interval: Optional[float] = None):
+        self.flush_interval = settings.JOB_BUFFER_FLUSH_SEC if flush_interval is None else flush_interval
+        self._pending: Dict[str, _PendingJob] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.flush_interval > 0
+
+    def _pending_for(self, job_id: str) -> _PendingJob:
+        pending = self._pending.get(job_id)
+        if pending is None:
+            pending = self._pending[job_id] = _PendingJob(_owners.get(job_id))
+        return pending
+
+    def set_fields(self, job_id: str, fields: Dict[str, Any]) -> None:
+        self._pending_for(job_id).fields.update(fields)
+        self._ensure_started()
+
+    def push_event(self, job_id: str, event: Dict[str, Any]) -> None:
+        self._pending_for(job_id).events.append(event)
+        self._ensure_started()
+
+    def discard(self, job_id: str) -> None:
+        """Descarta lo pendiente de un job (lease perdido: ya es de otro worker)."""
+        self._pending.pop(job_id, None)
+
+    def snapshot(self, job_id: str) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        """Cambios pendientes (campos, eventos) de un job, para servir lecturas frescas."""
+        pending = self._pending.get(job_id)
+        if pending is None:
+            return None
+        return dict(pending.fields), list(pending.events)
+
+    async def flush_job(self, job_id: str) -> None:
+        pending = self._pending.pop(job_id, None)
+        if pending is None:
+            return
+        
+        # Eventos primero: cuando la etapa terminal llega al job, su log ya está persistido
+        if pending.events:
+            try:
+                owned = await insert_events(job_id, pending.events, pending.owner)
+            except Exception as e:
+                logger.error(f"Error persistiendo eventos del job {job_id}: {e}")
+                self._restore(job_id, pending)
+                return
+            if not owned:
+                logger.warning(f"Job {job_id} ya no pertenece a {pending.owner}; se descarta su telemetría")
+                return
+            pending.events = []
+        
+        try:
+            await get_collection(Job).update_one(
+                owner_filter(job_id, pending.owner),
+                {"$set": {**pending.fields, "updated_at": time.time()}}
+            )
+        except Exception as e:
+            logger.error(f"Error persistiendo telemetría del job {job_id}: {e}")
+            self._restore(job_id, pending)
+
+    async def flush_all(self) -> None:
+        for job_id in list(self._pending.keys()):
+            await self.flush_job(job_id)
+
+    async def stop(self) -> None:
+        """Detiene el loop de flush y persiste lo pendiente."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_all()
+
+    def _restore(self, job_id: str, pending: _PendingJob) -> None:
+        # Reinsertar respetando lo que haya llegado mientras tanto (más reciente gana)
+        current = self._pending.get(job_id)
+        if current is None:
+            self._pending[job_id] = pending
+            return
+        pending.fields.update(current.fields)
+        current.fields = pending.fields
+        current.events = pending.events + current.events
+
+    def _ensure_started(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        except RuntimeError:
+            # Sin event loop: el siguiente flush explícito persistirá los cambios
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_all()
+
+
+# Singleton instance
+_buffer: Optional[JobTelemetryBuffer] = None
+
+def get_job_buffer() -> JobTelemetryBuffer:
+    global _buffer
+    if _buffer is None:
+        _buffer = JobTelemetryBuffer()
+    return _buffer
+
+async def shutdown_job_buffer() -> None:
+    global _buffer
+    if _buffer is not None:
+        await _buffer.stop()
+        _buffer = None
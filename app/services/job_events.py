@@ -0,0 +1,53 @@
+"""
+Pub/sub en proceso para el progreso de jobs
+El módulo `jobs` publica cada cambio (etapa/progreso, eventos, resultados)
+y los streams SSE se suscriben por job_id.
+"""
+
+import asyncio
+from typing import Dict, Any, Set
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JobEventBus:
+    """Fan-out de mensajes por job_id hacia colas asyncio de suscriptores."""
+
+    def __init__(self, max_queue: int = 256):
+        self.max_queue = max_queue
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queue)
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue) -> None:
+        subs = self._subscribers.get(job_id)
+        if not subs:
+            return
+        subs.discard(queue)
+        if not subs:
+            self._subscribers.pop(job_id, None)
+
+    def publish(self, job_id: str, kind: str, data: Dict[str, Any]) -> None:
+        subs = self._subscribers.get(job_id)
+        if not subs:
+            return
+        message = {"type": kind, "data": data}
+        for queue in subs:
+            if queue.full():
+                # Cliente lento: descartar el mensaje más antiguo
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            queue.put_nowait(message)
+
+
+# Singleton instance
+_bus = JobEventBus()
+
+def get_job_event_bus() -> JobEventBus:
+    return _bus
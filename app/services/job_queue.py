@@ -0,0 +1,221 @@
+"""
+Cola durable de jobs sobre la colección `jobs` de MongoDB
+- Claim atómico con find-and-modify (stage QUEUED -> STARTED + lease)
+- Heartbeats que renuevan el lease mientras el job se ejecuta
+- Reintentos con backoff exponencial hasta max_attempts
+- Recuperación de jobs cuyo worker murió (lease expirado)
+"""
+
+import asyncio
+import os
+import socket
+import time
+import traceback
+from typing import Any, Dict, Optional
+from pymongo import ReturnDocument
+from app.core.config import settings
+from app.core.db import get_collection
+from app.schemas.fibo import Job
+from app.services import jobs
+from app.services.job_buffer import get_job_buffer, set_owner, release_owner, retention_expires_at
+from app.services.generation import run_generation_job
+import logging
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STAGES_EXCLUDED = [jobs.JobStage.QUEUED.value, jobs.JobStage.DONE.value, jobs.JobStage.ERROR.value]
+
+
+def default_worker_id(prefix: str = "worker") -> str:
+    return f"{prefix}-{socket.gethostname()}-{os.getpid()}"
+
+
+def _collection():
+    return get_collection(Job)
+
+
+def _claimable_filter(now: float) -> Dict[str, Any]:
+    return {
+        "$or": [
+            # Pendientes cuyo turno (backoff) ya llegó
+            {"stage": jobs.JobStage.QUEUED.value, "next_run_at": {"$lte": now}},
+            # En ejecución pero con el lease vencido (worker caído)
+            {"stage": {"$nin": ACTIVE_STAGES_EXCLUDED}, "lease_expires_at": {"$lt": now}},
+        ],
+        "$expr": {"$lt": ["$attempts", "$max_attempts"]},
+    }
+
+
+def _claim_update(worker_id: str, now: float, lease_sec: float) -> Dict[str, Any]:
+    return {
+        "$set": {
+            "stage": jobs.JobStage.STARTED.value,
+            "worker_id": worker_id,
+            "lease_expires_at": now + lease_sec,
+            "updated_at": now,
+        },
+        "$inc": {"attempts": 1},
+    }
+
+
+async def claim_next(worker_id: str, lease_sec: Optional[float] = None) -> Optional[Job]:
+    """Reclama atómicamente el próximo job disponible (o None si la cola está vacía)."""
+    now = time.time()
+    doc = await _collection().find_one_and_update(
+        _claimable_filter(now),
+        _claim_update(worker_id, now, lease_sec or settings.JOB_LEASE_SEC),
+        sort=[("next_run_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+    return Job.model_validate(doc) if doc else None
+
+
+async def claim_job(job_id: str, worker_id: str, lease_sec: Optional[float] = None) -> Optional[Job]:
+    """Reclama un job concreto; None si otro worker ya lo tomó."""
+    now = time.time()
+    query = _claimable_filter(now)
+    query["job_id"] = job_id
+    doc = await _collection().find_one_and_update(
+        query,
+        _claim_update(worker_id, now, lease_sec or settings.JOB_LEASE_SEC),
+        return_document=ReturnDocument.AFTER,
+    )
+    return Job.model_validate(doc) if doc else None
+
+
+async def heartbeat(job_id: str, worker_id: str, lease_sec: Optional[float] = None) -> bool:
+    """Renueva el lease; False si el job ya no pertenece a este worker."""
+    result = await _collection().update_one(
+        {"job_id": job_id, "worker_id": worker_id},
+        {"$set": {"lease_expires_at": time.time() + (lease_sec or settings.JOB_LEASE_SEC)}},
+    )
+    return result.matched_count > 0
+
+
+async def _release(job_id: str, worker_id: str) -> None:
+    await _collection().update_one(
+        {"job_id": job_id, "worker_id": worker_id},
+        {"$set": {"lease_expires_at": None}},
+    )
+
+
+async def retry_or_fail(job: Job, worker_id: str, error_msg: str, trace: str = "") -> None:
+    """Reencola con backoff exponencial o marca el job como fallido."""
+    # Persistir telemetría pendiente antes de cambiar de etapa
+    await jobs.flush_job(job.job_id)
+    
+    if job.attempts < job.max_attempts:
+        delay = settings.JOB_RETRY_BACKOFF_SEC * (2 ** max(job.attempts - 1, 0))
+        await jobs.add_event(job.job_id, f"Intento {job.attempts}/{job.max_attempts} falló: {error_msg}. Reintentando en {int(delay)}s")
+        await jobs.flush_job(job.job_id)
+        await _collection().update_one(
+            {"job_id": job.job_id, "worker_id": worker_id},
+            {"$set": {
+                "stage": jobs.JobStage.QUEUED.value,
+                "next_run_at": time.time() + delay,
+                "lease_expires_at": None,
+                "worker_id": None,
+                "error": error_msg,
+                # El reintento regenera todas las variaciones desde cero
+                "results": [],
+                "partial_results": [],
+                "updated_at": time.time(),
+            }},
+        )
+        jobs.get_job_event_bus().publish(job.job_id, "update", {
+            "stage": jobs.JobStage.QUEUED.value, "error": error_msg, "results": [], "partial_results": []
+        })
+        return
+    
+    await jobs.fail_job(job.job_id, error_msg, trace=trace, worker_id=worker_id)
+
+
+async def fail_abandoned() -> int:
+    """
+    Marca como ERROR los jobs con lease vencido que agotaron sus intentos.
+    Cada job se toma con un find-and-modify condicionado: aunque todos los
+    procesos corran este barrido, solo uno escribe el fallo y su evento.
+    """
+    error_msg = "Worker perdido y sin intentos restantes"
+    count = 0
+    while True:
+        now = time.time()
+        doc = await _collection().find_one_and_update(
+            {
+                "stage": {"$nin": ACTIVE_STAGES_EXCLUDED},
+                "lease_expires_at": {"$lt": now},
+                "$expr": {"$gte": ["$attempts", "$max_attempts"]},
+            },
+            {"$set": {
+                "stage": jobs.JobStage.ERROR.value,
+                "progress": 100,
+                "error": error_msg,
+                "lease_expires_at": None,
+                "worker_id": None,
+                "expires_at": retention_expires_at(),
+                "updated_at": now,
+            }},
+            projection={"job_id": 1},
+        )
+        if doc is None:
+            return count
+        await jobs.add_event(doc["job_id"], f"Job failed: {error_msg}")
+        jobs.get_job_event_bus().publish(doc["job_id"], "update", {
+            "stage": jobs.JobStage.ERROR.value, "progress": 100, "error": error_msg
+        })
+        count += 1
+
+
+async def _heartbeat_loop(job_id: str, worker_id: str, work: asyncio.Task) -> bool:
+    """Renueva el lease mientras `work` corre; si se pierde, cancela `work` y devuelve True."""
+    while True:
+        await asyncio.sleep(settings.JOB_HEARTBEAT_SEC)
+        try:
+            owned = await heartbeat(job_id, worker_id)
+        except Exception as e:
+            # Error transitorio de MongoDB: se reintenta en el próximo beat
+            logger.error(f"Heartbeat fallido para {job_id}: {e}")
+            continue
+        if not owned:
+            logger.warning(f"Lease perdido para {job_id} (worker {worker_id}); cancelando ejecución")
+            work.cancel()
+            return True
+
+
+async def run_job(job: Job, worker_id: str) -> None:
+    """Ejecuta un job reclamado manteniendo el lease vivo."""
+    # La telemetría del job se escribe condicionada a este lease
+    set_owner(job.job_id, worker_id)
+    work = asyncio.create_task(run_generation_job(job, worker_id=worker_id))
+    beat = asyncio.create_task(_heartbeat_loop(job.job_id, worker_id, work))
+    try:
+        await work
+        await _release(job.job_id, worker_id)
+    except asyncio.CancelledError:
+        if beat.done() and not beat.cancelled() and beat.result():
+            # Lease perdido: el job ya es de otro worker, no reintentar ni escribir
+            get_job_buffer().discard(job.job_id)
+            return
+        # Apagado del worker: otro worker lo retomará al vencer el lease
+        work.cancel()
+        raise
+    except Exception as e:
+        logger.exception(f"Job {job.job_id} failed (attempt {job.attempts}/{job.max_attempts})")
+        await retry_or_fail(job, worker_id, str(e), trace=traceback.format_exc())
+    finally:
+        beat.cancel()
+        release_owner(job.job_id, worker_id)
+
+
+async def run_inline(job_id: str) -> None:
+    """
+    Modo background: el web worker que creó el job lo ejecuta, pero pasando
+    por el claim/lease de la cola para que un worker dedicado pueda
+    retomarlo si este proceso se reinicia.
+    """
+    worker_id = default_worker_id("web")
+    job = await claim_job(job_id, worker_id)
+    if not job:
+        logger.info(f"Job {job_id} ya fue reclamado por otro worker")
+        return
+    await run_job(job, worker_id)
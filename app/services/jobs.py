@@ -3,7 +3,13 @@ import time
 import logging
 from typing import Dict, Any, Optional, List
 from enum import Enum
-from app.schemas.fibo import Job
+from app.core.config import settings
+from app.core.db import get_collection
+from app.schemas.fibo import Job, JobEvent
+from app.services.job_buffer import (
+    get_job_buffer, insert_events, reserve_seq, telemetry_lock, owner_filter, retention_expires_at, MAX_EVENTS
+)
+from app.services.job_events import get_job_event_bus  # re-export para los streams SSE
 
 logger = logging.getLogger(__name__)
 
@@ -27,13 +33,24 @@ class JobStage(str, Enum):
     DONE = "DONE"
     ERROR = "ERROR"
 
+# Etapas tras las cuales la telemetría se persiste de inmediato
+TERMINAL_STAGES = (JobStage.DONE, JobStage.ERROR)
+
+# Campos seleccionables en lecturas parciales (sin _id ni revision_id de Beanie)
+STATUS_FIELDS = frozenset(Job.model_fields) - {"id", "revision_id"}
+# Siempre presentes: identifican el job, validan ownership y dicen si terminó
+STATUS_REQUIRED_FIELDS = frozenset({"job_id", "user_id", "stage", "updated_at"})
+# Listas con timestamp "t" que se recortan con `since`
+STATUS_DELTA_FIELDS = ("events", "partial_results")
+
 async def create_job(
     prompt: str,
     brand_guidelines: str = "",
     variations: int = 4,
     aspect_ratio: str = "1:1",
     image_path: Optional[str] = None,
-    user_id: Optional[str] = None
+    user_id: Optional[str] = None,
+    image_hash: Optional[str] = None
 ) -> Job:
     job_id = f"job_{uuid.uuid4().hex[:10]}"
     job = Job(
@@ -44,8 +61,11 @@ async def create_job(
         brand_guidelines=brand_guidelines,
         aspect_ratio=aspect_ratio,
         image_path=image_path,
+        image_hash=image_hash,
+        max_attempts=settings.JOB_MAX_ATTEMPTS,
         created_at=time.time(),
-        updated_at=time.time()
+        updated_at=time.time(),
+        next_run_at=time.time()
     )
     await job.insert()
     return job
@@ -53,60 +73,176 @@ async def create_job(
 async def get_job(job_id: str) -> Optional[Job]:
     return await Job.find_one(Job.job_id == job_id)
 
-async def get_job_status(job_id: str) -> Optional[Dict[str, Any]]:
-    job = await get_job(job_id)
-    if job:
+async def get_job_events(job_id: str, limit: int = MAX_EVENTS, since: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Eventos persistidos de un job, en orden de commit (seq).
+    Sin `since`: los últimos `limit`. Con `since`: los primeros `limit` con seq posterior.
+    """
+    if since is None:
+        docs = await JobEvent.find(JobEvent.job_id == job_id).sort("-seq").limit(limit).to_list()
+        docs.reverse()
+    else:
+        docs = await JobEvent.find(JobEvent.job_id == job_id, JobEvent.seq > since).sort("+seq").limit(limit).to_list()
+    return [{"seq": d.seq, "t": d.t, "msg": d.msg} for d in docs]
+
+def _next_since(status: Dict[str, Any], since: Optional[int]) -> int:
+    """Cursor para el siguiente poll: el mayor seq entregado (o el `since` recibido)."""
+    seqs = [item.get("seq") for name in STATUS_DELTA_FIELDS for item in status.get(name) or []]
+    seqs = [s for s in seqs if s is not None]
+    return max(seqs, default=since or 0)
+
+def _status_projection(fields: frozenset, since: Optional[int]) -> Dict[str, Any]:
+    projection: Dict[str, Any] = {"_id": 0}
+    for name in fields:
+        if name in STATUS_DELTA_FIELDS and since is not None:
+            # Recortar en Mongo: solo viajan los elementos posteriores a `since`
+            projection[name] = {"$filter": {
+                "input": {"$ifNull": [f"${name}", []]},
+                "as": "item",
+                "cond": {"$gt": ["$$item.seq", since]},
+            }}
+        else:
+            projection[name] = 1
+    return projection
+
+async def get_job_status(
+    job_id: str,
+    since: Optional[int] = None,
+    fields: Optional[List[str]] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Estado de un job. `fields` limita los campos devueltos (ver STATUS_FIELDS)
+    y `since` deja solo los eventos y partial_results con seq posterior.
+    `next_since` es el cursor a enviar en el siguiente poll.
+    Leer no fuerza escrituras: los campos pendientes del buffer se superponen,
+    y los eventos pendientes (sin seq hasta persistirse, en orden de commit)
+    aparecen tras el próximo flush.
+    """
+    if since is None and fields is None:
+        job = await get_job(job_id)
+        if not job:
+            return None
         # Pydantic/Beanie model to dict
-        return job.model_dump()
-    return None
+        status = job.model_dump()
+        selected = STATUS_FIELDS
+    else:
+        selected = (frozenset(fields) & STATUS_FIELDS if fields else STATUS_FIELDS) | STATUS_REQUIRED_FIELDS
+        status = await get_collection(Job).find_one({"job_id": job_id}, _status_projection(selected, since))
+        if not status:
+            return None
+    
+    # Telemetría de este proceso aún en el buffer write-behind: más reciente que Mongo
+    pending = get_job_buffer().snapshot(job_id)
+    if pending:
+        status.update({k: _to_mongo(v) for k, v in pending[0].items() if k in selected})
+    
+    if "events" in selected:
+        # Jobs anteriores a job_events conservan su lista embebida
+        events = status.get("events") or []
+        events += await get_job_events(job_id, since=since)
+        status["events"] = events[:MAX_EVENTS] if since is not None else events[-MAX_EVENTS:]
+    
+    status["next_since"] = _next_since(status, since)
+    return status
+
+async def flush_job(job_id: str):
+    """Persiste de inmediato la telemetría pendiente de un job."""
+    await get_job_buffer().flush_job(job_id)
+
+def _job_filter(job_id: str):
+    # Todas las escrituras van por el índice único job_id, en un solo round trip,
+    # y condicionadas al lease si este proceso ejecuta el job
+    return Job.find_one(owner_filter(job_id))
+
+def _to_mongo(value: Any) -> Any:
+    return value.value if isinstance(value, Enum) else value
 
 async def update_job(job_id: str, **kwargs):
-    job = await get_job(job_id)
-    if not job:
+    fields = {k: _to_mongo(v) for k, v in kwargs.items() if k in Job.model_fields}
+    get_job_event_bus().publish(job_id, "update", {k: v for k, v in fields.items() if k != "trace"})
+    buffer = get_job_buffer()
+    if not buffer.enabled:
+        fields["updated_at"] = time.time()
+        await _job_filter(job_id).update({"$set": fields})
         return
     
-    for k, v in kwargs.items():
-        if hasattr(job, k):
-            setattr(job, k, v)
-    job.updated_at = time.time()
-    await job.save()
+    buffer.set_fields(job_id, fields)
+    if fields.get("stage") in TERMINAL_STAGES:
+        await buffer.flush_job(job_id)
 
 async def add_event(job_id: str, message: str):
-    job = await get_job(job_id)
-    if not job:
+    event = {"t": time.time(), "msg": message}
+    get_job_event_bus().publish(job_id, "event", event)
+    buffer = get_job_buffer()
+    if buffer.enabled:
+        buffer.push_event(job_id, event)
         return
     
-    job.events.append({
-        "t": time.time(),
-        "msg": message
-    })
-    # Keep only last 250 events
-    if len(job.events) > 250:
-        job.events = job.events[-250:]
-    job.updated_at = time.time()
-    await job.save()
+    if await insert_events(job_id, [event]):
+        await _job_filter(job_id).update({"$set": {"updated_at": time.time()}})
 
 async def add_result(job_id: str, result_url: str):
-    job = await get_job(job_id)
-    if not job:
-        return
-    if result_url not in job.results:
-        job.results.append(result_url)
-    job.updated_at = time.time()
-    await job.save()
+    get_job_event_bus().publish(job_id, "result", {"image_url": result_url})
+    await _job_filter(job_id).update({
+        "$addToSet": {"results": result_url},
+        "$set": {"updated_at": time.time()}
+    })
 
 async def add_partial_result(job_id: str, partial: Dict[str, Any]):
-    job = await get_job(job_id)
-    if not job:
-        return
-    job.partial_results.append(partial)
-    job.updated_at = time.time()
-    await job.save()
+    # "seq" (compartido con los eventos) permite pedir solo los parciales nuevos (GET /jobs/{id}?since=)
+    async with telemetry_lock(job_id):
+        seq = await reserve_seq(job_id)
+        if seq is None:
+            return
+        partial = {**partial, "seq": seq, "t": partial.get("t", time.time())}
+        await _job_filter(job_id).update({
+            "$push": {"partial_results": partial},
+            "$set": {"updated_at": time.time()}
+        })
+    get_job_event_bus().publish(job_id, "partial_result", partial)
+
+async def _finish_owned(job_id: str, worker_id: str, message: str, **kwargs) -> bool:
+    """
+    Escritura terminal condicionada al lease: el evento final y la etapa
+    terminal solo se escriben si el job sigue asignado a `worker_id`.
+    False si otro worker lo reclamó mientras tanto.
+    """
+    fields = {k: _to_mongo(v) for k, v in kwargs.items() if k in Job.model_fields}
+    event = {"t": time.time(), "msg": message}
+    await flush_job(job_id)
+    # El log terminal queda persistido antes de que la etapa terminal sea visible
+    if await insert_events(job_id, [event], owner=worker_id):
+        result = await get_collection(Job).update_one(
+            {"job_id": job_id, "worker_id": worker_id},
+            {"$set": {**fields, "lease_expires_at": None, "updated_at": time.time()}},
+        )
+        owned = result.matched_count > 0
+    else:
+        owned = False
+    if not owned:
+        logger.warning(f"Job {job_id} ya no pertenece a {worker_id}; se descarta su resultado")
+        return False
+    bus = get_job_event_bus()
+    bus.publish(job_id, "event", event)
+    bus.publish(job_id, "update", {k: v for k, v in fields.items() if k != "trace"})
+    return True
 
-async def complete_job(job_id: str, results: List[str]):
-    await update_job(job_id, stage=JobStage.DONE, progress=100, results=results)
-    await add_event(job_id, "Job completed successfully")
+async def complete_job(job_id: str, results: List[str], worker_id: Optional[str] = None) -> bool:
+    message = "Job completed successfully"
+    fields = dict(stage=JobStage.DONE, progress=100, results=results, expires_at=retention_expires_at())
+    if worker_id is not None:
+        return await _finish_owned(job_id, worker_id, message, **fields)
+    # El evento se encola antes de la etapa terminal para que ambos
+    # se persistan en el mismo flush
+    await add_event(job_id, message)
+    await update_job(job_id, **fields)
+    return True
 
-async def fail_job(job_id: str, error_msg: str, trace: str = ""):
-    await update_job(job_id, stage=JobStage.ERROR, progress=100, error=error_msg, trace=trace)
-    await add_event(job_id, f"Job failed: {error_msg}")
+async def fail_job(job_id: str, error_msg: str, trace: str = "", worker_id: Optional[str] = None) -> bool:
+    message = f"Job failed: {error_msg}"
+    fields = dict(stage=JobStage.ERROR, progress=100, error=error_msg, trace=trace, expires_at=retention_expires_at())
+    if worker_id is not None:
+        return await _finish_owned(job_id, worker_id, message, **fields)
+    await add_event(job_id, message)
+    await update_job(job_id, **fields)
+    return True
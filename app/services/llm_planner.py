@@ -1,12 +1,86 @@
 import json
 import os
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator
 import requests
 from app.core.config import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+class PatchStreamParser:
+    """
+    Parser incremental del array JSON de patches que devuelve el LLM.
+    `feed()` recibe fragmentos del stream y devuelve los objetos del primer
+    array que ya se cerraron (acepta fences ``` y wrappers {"variations": [...]}).
+    Un objeto inválido se descarta sin perder los anteriores ni los siguientes.
+    """
+
+    def __init__(self) -> None:
+        self._buf: List[str] = []
+        self._stack: List[str] = []      # contenedores abiertos ("{" / "[")
+        self._array_depth: Optional[int] = None  # profundidad del array de patches
+        self._start: Optional[int] = None  # inicio del objeto en curso dentro de _buf
+        self._pos = 0
+        self._in_string = False
+        self._escape = False
+        self.closed = False  # el array terminó; el resto del stream se ignora
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        if self.closed or not chunk:
+            return out
+        self._buf.append(chunk)
+        text = "".join(self._buf)
+        self._buf = [text]
+        
+        while self._pos < len(text) and not self.closed:
+            ch = text[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                if ch == "[" and self._array_depth is None:
+                    self._array_depth = len(self._stack) + 1
+                elif ch == "{" and self._array_depth is not None and len(self._stack) == self._array_depth:
+                    self._start = self._pos
+                self._stack.append(ch)
+            elif ch in "}]" and self._stack:
+                self._stack.pop()
+                if self._array_depth is not None:
+                    if ch == "}" and self._start is not None and len(self._stack) == self._array_depth:
+                        patch = self._load(text[self._start:self._pos + 1])
+                        if patch is not None:
+                            out.append(patch)
+                        self._start = None
+                    elif ch == "]" and len(self._stack) < self._array_depth:
+                        self.closed = True
+            self._pos += 1
+        
+        # Descartar lo ya consumido que no pertenece a un objeto en curso
+        keep_from = self._start if self._start is not None else self._pos
+        if keep_from:
+            self._buf = [text[keep_from:]]
+            self._pos -= keep_from
+            if self._start is not None:
+                self._start = 0
+        return out
+
+    @staticmethod
+    def _load(raw: str) -> Optional[Dict[str, Any]]:
+        try:
+            patch = json.loads(raw)
+        except json.JSONDecodeError:
+            logger.warning(f"Patch inválido descartado: {raw[:120]}")
+            return None
+        return patch if isinstance(patch, dict) else None
+
 class LLMPlanner:
     """
     Planificador que usa LLM (Ollama) para crear variaciones de prompts.
@@ -19,19 +93,17 @@ class LLMPlanner:
         self.model = settings.LLM_MODEL_NAME
         
         self.client = None
+        self.async_client = None
         if self.api_key:
-            from openai import OpenAI  # sync client for simplicity in this flow, or Async if method is async
+            from openai import OpenAI, AsyncOpenAI
             self.client = OpenAI(api_key=self.api_key, base_url=self.base_url)
+            # Cliente async para stream_patches (no bloquea el event loop)
+            self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url)
         else:
             logger.warning("OPENAI_API_KEY no encontrada. Se usará fallback dummy.")
 
-    def propose_patches(self, user_prompt: str, base_sp: Dict[str, Any], brand_ctx: str, n: int) -> List[Dict[str, Any]]:
-        """
-        Genera N variaciones (patches) usando el LLM configurado (Groq/OpenAI).
-        """
-        if not self.client:
-            return self._fallback(n)
-            
+    @staticmethod
+    def _build_messages(user_prompt: str, base_sp: Dict[str, Any], brand_ctx: str, n: int) -> List[Dict[str, str]]:
         system = (
             "Eres un AI Art Director de clase mundial y Trend Forecaster. "
             "Tu objetivo es generar conceptos visuales de ALTO IMPACTO para e-commerce. "
@@ -55,14 +127,22 @@ class LLMPlanner:
             f"Create {n} DISTINCT and DRAMATIC variations based on Analysis."
             f"Base SP: {json.dumps(base_sp)}"
         )
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user_msg}
+        ]
+
+    def propose_patches(self, user_prompt: str, base_sp: Dict[str, Any], brand_ctx: str, n: int) -> List[Dict[str, Any]]:
+        """
+        Genera N variaciones (patches) usando el LLM configurado (Groq/OpenAI).
+        """
+        if not self.client:
+            return self._fallback(n)
         
         try:
             response = self.client.chat.completions.create(
                 model=self.model,
-                messages=[
-                    {"role": "system", "content": system},
-                    {"role": "user", "content": user_msg}
-                ],
+                messages=self._build_messages(user_prompt, base_sp, brand_ctx, n),
                 # response_format={"type": "json_object"}, # Groq supports this usually
                 temperature=0.8
             )
@@ -84,6 +164,55 @@ class LLMPlanner:
             
         return self._fallback(n)
 
+    async def stream_patches(
+        self,
+        user_prompt: str,
+        base_sp: Dict[str, Any],
+        brand_ctx: str,
+        n: int
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Versión streaming de propose_patches: cede cada patch apenas el LLM
+        cierra su objeto, para empezar a generar imágenes sin esperar al resto.
+        Siempre cede exactamente N patches: si el stream falla o la cola viene
+        malformada se conservan los ya recibidos y se completa con presets.
+        """
+        count = 0
+        failed = not self.async_client
+        if self.async_client:
+            parser = PatchStreamParser()
+            stream = None
+            try:
+                stream = await self.async_client.chat.completions.create(
+                    model=self.model,
+                    messages=self._build_messages(user_prompt, base_sp, brand_ctx, n),
+                    temperature=0.8,
+                    stream=True
+                )
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    for patch in parser.feed(chunk.choices[0].delta.content or ""):
+                        yield patch
+                        count += 1
+                        if count >= n:
+                            break
+                    if count >= n or parser.closed:
+                        break
+            except Exception as e:
+                logger.exception(f"Error LLM stream ({self.model}): {e}")
+                failed = True
+            finally:
+                # Cortar la respuesta si ya tenemos los N patches
+                if stream is not None:
+                    await stream.close()
+        
+        # Igual que propose_patches: faltantes como {} si el LLM devolvió menos,
+        # presets si no devolvió nada útil o el stream se cortó
+        filler = self._fallback(n) if failed or count == 0 else [{}] * n
+        for patch in filler[count:n]:
+            yield patch
+
     @staticmethod
     def _safe_json_extract(text: str) -> Optional[str]:
         """Extrae el primer bloque JSON válido de un string (hacky robustez)."""
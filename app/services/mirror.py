@@ -0,0 +1,172 @@
+"""
+Espejado de imágenes generadas por Bria en nuestro bucket
+Las URLs de resultado de Bria (CloudFront firmadas con `Expires=`) caducan.
+Este pipeline descarga cada resultado en segundo plano, lo sube a Supabase
+con clave por contenido (deduplicado vía StoredImage), genera sus miniaturas
+y reescribe las URLs guardadas en Plan.proposed_variations y en
+Job.results/partial_results.
+
+Las tareas viven en memoria: el plan se persiste con `mirror_pending=True` y
+el flag se limpia al terminar, así mirror_history.py retoma lo que un
+reinicio haya cortado.
+"""
+
+import asyncio
+import hashlib
+import tempfile
+from typing import Awaitable, Dict, Iterable, List, Optional
+import httpx
+from beanie import PydanticObjectId
+from app.core.config import settings
+from app.core.db import get_collection
+from app.schemas.fibo import Job, Plan, StoredImage
+from app.services import background, derivatives, storage
+from app.services.http_client import get_http_client
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tamaño máximo de descarga por imagen
+MAX_MIRROR_BYTES = 50 * 1024 * 1024
+
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(settings.MIRROR_MAX_CONCURRENCY)
+    return _semaphore
+
+
+def _extension(content_type: Optional[str]) -> str:
+    if not content_type:
+        return "png"
+    return content_type.split(";")[0].split("/")[-1].split("+")[0] or "png"
+
+
+async def _download_and_store(url: str, user_id: str) -> StoredImage:
+    """Descarga en streaming a un archivo temporal (hasheando) y lo sube al bucket."""
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as tmp:
+        digest = hashlib.sha256()
+        size = 0
+        async with get_http_client().stream("GET", url, timeout=60.0) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("content-type")
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > MAX_MIRROR_BYTES:
+                    raise ValueError(f"Imagen excede {MAX_MIRROR_BYTES} bytes")
+                digest.update(chunk)
+                tmp.write(chunk)
+        
+        sha256 = digest.hexdigest()
+        stored = await storage.find_stored(user_id, sha256)
+        if stored is None:
+            tmp.seek(0)
+            stored = await storage.store_fileobj(
+                tmp, user_id, sha256, size, content_type, _extension(content_type), folder="results/"
+            )
+        
+        # Miniaturas mientras los bytes siguen a mano (no bloquea el espejado si fallan)
+        if derivatives.enabled() and not stored.derivatives:
+            try:
+                tmp.seek(0)
+                await derivatives.ensure_derivatives(stored, tmp.read())
+            except Exception as e:
+                logger.warning(f"No se pudieron generar derivados de {stored.key}: {e}")
+        return stored
+
+
+async def mirror_image(url: str, user_id: str) -> Optional[StoredImage]:
+    """Devuelve la imagen espejada o None si falló tras MIRROR_MAX_ATTEMPTS intentos."""
+    if storage.is_own_url(url):
+        return None
+    
+    error: Optional[Exception] = None
+    for attempt in range(1, settings.MIRROR_MAX_ATTEMPTS + 1):
+        try:
+            async with _get_semaphore():
+                return await _download_and_store(url, user_id)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code in (403, 404):
+                # URL expirada o inexistente: reintentar no sirve
+                logger.warning(f"No se puede espejar {url[:80]}...: {e.response.status_code}")
+                return None
+            error = e
+        except Exception as e:
+            error = e
+        
+        if attempt < settings.MIRROR_MAX_ATTEMPTS:
+            await asyncio.sleep(2 ** attempt)
+    
+    logger.error(f"Error espejando {url[:80]}... tras {settings.MIRROR_MAX_ATTEMPTS} intentos: {error}")
+    return None
+
+
+async def mirror_urls(urls: Iterable[Optional[str]], user_id: str) -> Dict[str, StoredImage]:
+    """Espeja varias URLs en paralelo (acotado). Devuelve {url_original: imagen_espejada}."""
+    unique = [u for u in dict.fromkeys(urls) if u and not storage.is_own_url(u)]
+    mirrored = await asyncio.gather(*[mirror_image(u, user_id) for u in unique])
+    return {old: stored for old, stored in zip(unique, mirrored) if stored}
+
+
+async def rewrite_plan_urls(plan_id: str, mapping: Dict[str, StoredImage]) -> None:
+    """Reemplaza generated_image_url (y agrega derivative_urls) en las variaciones del plan, en una sola escritura."""
+    if not mapping:
+        return
+    update, filters = {}, []
+    for i, (old, stored) in enumerate(mapping.items()):
+        update[f"proposed_variations.$[v{i}].generated_image_url"] = stored.url
+        if stored.derivatives:
+            update[f"proposed_variations.$[v{i}].derivative_urls"] = stored.derivatives
+        filters.append({f"v{i}.generated_image_url": old})
+    await get_collection(Plan).update_one(
+        {"_id": PydanticObjectId(plan_id)}, {"$set": update}, array_filters=filters
+    )
+
+
+async def rewrite_job_urls(job_id: str, mapping: Dict[str, str]) -> None:
+    """Reemplaza las URLs en Job.results y Job.partial_results (una sola escritura)."""
+    if not mapping:
+        return
+    update, filters = {}, []
+    for i, (old, new) in enumerate(mapping.items()):
+        update[f"results.$[r{i}]"] = new
+        update[f"partial_results.$[p{i}].image_url"] = new
+        filters.append({f"r{i}": old})
+        filters.append({f"p{i}.image_url": old})
+    await get_collection(Job).update_one({"job_id": job_id}, {"$set": update}, array_filters=filters)
+
+
+async def mirror_plan(plan_id: str, job_id: Optional[str] = None) -> Dict[str, StoredImage]:
+    """Espeja los resultados de un plan (y del job que lo generó, si se indica o quedó guardado)."""
+    plan = await Plan.get(plan_id)
+    if not plan:
+        return {}
+    urls = [v.generated_image_url for v in plan.proposed_variations]
+    mapping = await mirror_urls(urls, plan.user_id)
+    await rewrite_plan_urls(plan_id, mapping)
+    job_id = job_id or plan.job_id
+    if job_id:
+        await rewrite_job_urls(job_id, {old: stored.url for old, stored in mapping.items()})
+    # Terminado (las URLs que fallaron ya agotaron sus intentos)
+    await get_collection(Plan).update_one(
+        {"_id": PydanticObjectId(plan_id)}, {"$set": {"mirror_pending": False}}
+    )
+    logger.info(f"Plan {plan_id}: {len(mapping)}/{len([u for u in urls if u])} imágenes espejadas")
+    return mapping
+
+
+def mark_pending(plan: Plan) -> Plan:
+    """Marca el plan (antes de persistirlo) como pendiente de espejar."""
+    plan.mirror_pending = settings.MIRROR_RESULTS_ENABLED
+    return plan
+
+
+def schedule(coro: Awaitable) -> None:
+    """Lanza el espejado en segundo plano sin bloquear la respuesta/job."""
+    if not settings.MIRROR_RESULTS_ENABLED:
+        coro.close()  # type: ignore[attr-defined]
+        return
+    background.spawn(coro)
@@ -1,11 +1,14 @@
 import json
 import uuid
+import asyncio
+import inspect
 import datetime
 import traceback
 import logging
 from pathlib import Path
-from typing import Optional, Dict, List, Any, Callable
+from typing import Optional, Dict, List, Any, Callable, Tuple, Union, Awaitable, AsyncIterator, AsyncIterable
 import base64
+import hashlib
 
 from app.core.config import settings
 from app.services.jobs import (
@@ -13,19 +16,32 @@ from app.services.jobs import (
     fail_job, add_partial_result
 )
 from app.services.bria_v2 import BriaV2Client
+from app.services.bria_poller import get_status_poller
 from app.services.rag import SimpleRAG
 from app.services.llm_planner import LLMPlanner
+from app.services.cache import MemoryLRUCache
+from app.services.images import preprocess_reference_image
+from app.services import prompt_patch
 
 logger = logging.getLogger(__name__)
 
-def _deep_update(dst: Dict[str, Any], src: Dict[str, Any]) -> Dict[str, Any]:
-    """Actualización recursiva de diccionarios."""
-    for k, v in src.items():
-        if isinstance(v, dict) and isinstance(dst.get(k), dict):
-            _deep_update(dst[k], v)
-        else:
-            dst[k] = v
-    return dst
+# Callback de progreso: puede ser una función normal o una corrutina
+StepCallback = Callable[[str, Dict[str, Any]], Union[None, Awaitable[None]]]
+
+async def _emit(on_step: Optional[StepCallback], stage_name: str, payload: Dict[str, Any]) -> None:
+    if on_step is None:
+        return
+    result = on_step(stage_name, payload)
+    if inspect.isawaitable(result):
+        await result
+
+async def _aiter(items: List[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    for item in items:
+        yield item
+
+def image_content_hash(image_b64: str) -> str:
+    """SHA-256 de los bytes de la imagen (identidad estable para caches)."""
+    return hashlib.sha256(base64.b64decode(image_b64)).hexdigest()
 
 class Orchestrator:
     """
@@ -39,9 +55,25 @@ class Orchestrator:
         self.planner = LLMPlanner()
         self.data_dir = Path(settings.DATA_DIR)
         self.data_dir.mkdir(parents=True, exist_ok=True)
-
-    def _load_image_base64(self, image_path: str) -> Optional[str]:
-        """Carga imagen desde disco y convierte a base64."""
+        # Análisis de Bria por (imagen, prompt): re-ejecutar el mismo producto
+        # con otras guidelines evita BRIA_SP_REQUEST/BRIA_SP_POLL
+        self.sp_cache = MemoryLRUCache(
+            "structured_prompt",
+            max_entries=settings.SP_CACHE_MAX_ENTRIES,
+            ttl=settings.SP_CACHE_TTL_SEC
+        )
+        # Imagen de referencia ya preprocesada (base64) por hash del original
+        self.image_cache = MemoryLRUCache(
+            "reference_images",
+            max_entries=settings.IMAGE_PREPROCESS_CACHE_ENTRIES
+        )
+
+    def _load_reference_image(self, image_path: str, image_hash: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """
+        Carga imagen desde disco, la preprocesa (reducción, re-codificación,
+        sin metadata) y la convierte a base64.
+        Devuelve (base64, sha256 del original); el resultado se cachea por hash.
+        """
         if not image_path:
             return None
         path = Path(image_path)
@@ -50,28 +82,35 @@ class Orchestrator:
         try:
             with open(path, "rb") as f:
                 data = f.read()
-            return base64.b64encode(data).decode("utf-8")
+            image_hash = image_hash or hashlib.sha256(data).hexdigest()
+            
+            image_b64 = self.image_cache.get_nowait(image_hash)
+            if image_b64 is None:
+                processed = preprocess_reference_image(data)
+                image_b64 = base64.b64encode(processed).decode("utf-8")
+                self.image_cache.set_nowait(image_hash, image_b64)
+                logger.info(f"Imagen de referencia preprocesada: {len(data)} -> {len(processed)} bytes")
+            return image_b64, image_hash
         except Exception as e:
             logger.error(f"Error cargando imagen {image_path}: {e}")
             return None
 
-    def generate_plan(
+    def _load_image_base64(self, image_path: str) -> Optional[str]:
+        """Carga imagen desde disco y convierte a base64."""
+        loaded = self._load_reference_image(image_path)
+        return loaded[0] if loaded else None
+
+    async def _request_structured_prompt(
         self,
         prompt: str,
         image_b64: str,
-        brand_guidelines: Optional[str],
-        variations: int,
-        on_step: Optional[Callable[[str, Dict[str, Any]], None]] = None
-    ) -> Dict[str, Any]:
-        """
-        Fase 1: Generación del Plan.
-        Obtiene prompt base, aplica RAG y genera variaciones con LLM.
-        """
-        if on_step: on_step("BRIA_SP_REQUEST", {})
+        on_step: Optional[StepCallback] = None
+    ) -> Tuple[Dict[str, Any], Optional[int]]:
+        """Pide a Bria el structured prompt base de la imagen y espera el resultado."""
+        await _emit(on_step, "BRIA_SP_REQUEST", {})
         
-        # 1. Obtener Structured Prompt Base
         try:
-            init = self.bria.structured_prompt_generate(prompt, image_b64)
+            init = await self.bria.astructured_prompt_generate(prompt, image_b64)
             # Manejar status_url si es async o request_id si es sync simulado
             status_url = init.get("status_url")
             if not status_url and "request_id" in init:
@@ -81,8 +120,8 @@ class Orchestrator:
             
             # Si Bria devuelve status_url, hacemos poll
             if status_url:
-                if on_step: on_step("BRIA_SP_POLL", {"status_url": status_url})
-                done = self.bria.poll_until_done(status_url)
+                await _emit(on_step, "BRIA_SP_POLL", {"status_url": status_url})
+                done = await get_status_poller().wait(status_url)
             else:
                 # Si es síncrono o ya tenemos resultado
                 done = init
@@ -94,7 +133,7 @@ class Orchestrator:
             if not sp_str:
                 raise Exception(f"No se recibió structured_prompt válido: {done}")
             
-            base_sp = json.loads(sp_str)
+            return json.loads(sp_str), seed
 
         except Exception as e:
             logger.error(f"Error obteniendo structured prompt: {e}")
@@ -102,193 +141,345 @@ class Orchestrator:
             # Por ahora relanzamos para que falle el job
             raise e
 
+    async def _prepare_plan(
+        self,
+        prompt: str,
+        image_b64: str,
+        brand_guidelines: Optional[str],
+        on_step: Optional[StepCallback] = None,
+        image_hash: Optional[str] = None
+    ) -> Tuple[Dict[str, Any], Optional[int], str]:
+        """Structured prompt base (cacheado por imagen + prompt) y contexto RAG."""
+        # 1. Obtener Structured Prompt Base (cacheado por imagen + prompt)
+        sp_key = f"{image_hash or image_content_hash(image_b64)}:{hashlib.sha256(prompt.encode('utf-8')).hexdigest()}"
+        cached = self.sp_cache.get_nowait(sp_key)
+        if cached is not None:
+            base_sp, seed = cached["structured_prompt"], cached["seed"]
+            await _emit(on_step, "BRIA_SP_CACHED", {"stats": self.sp_cache.stats()})
+        else:
+            base_sp, seed = await self._request_structured_prompt(prompt, image_b64, on_step)
+            self.sp_cache.set_nowait(sp_key, {"structured_prompt": base_sp, "seed": seed})
+
         # 2. RAG Context
-        if on_step: on_step("RAG_CONTEXT", {})
+        await _emit(on_step, "RAG_CONTEXT", {})
         ctx = self.rag.load_context(brand_guidelines)
+        return base_sp, seed, ctx
 
-        # 3. LLM Patches
-        if on_step: on_step("LLM_PATCHES", {"model": self.planner.model})
-        patches = self.planner.propose_patches(prompt, base_sp, ctx, variations)
-
-        # 4. Crear Variaciones
-        sps = []
-        for i, patch in enumerate(patches):
-            sp = json.loads(json.dumps(base_sp)) # Deep copy
-            if patch:
-                _deep_update(sp, patch)
-            
+    async def _iter_variations(
+        self,
+        prompt: str,
+        base_sp: Dict[str, Any],
+        seed: Optional[int],
+        ctx: str,
+        variations: int,
+        on_step: Optional[StepCallback] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Cede cada variación del plan en cuanto el LLM termina su patch.
+        Las variaciones guardan solo su patch; el prompt completo se arma al
+        enviarlo a Bria (ver variation_prompt).
+        """
+        # 3. LLM Patches (streaming)
+        await _emit(on_step, "LLM_PATCHES", {"model": self.planner.model})
+        i = 0
+        async for patch in self.planner.stream_patches(prompt, base_sp, ctx, variations):
+            # 4. Crear Variación
             # Variar seed ligeramente para diversidad extra si se desea, o mantener
             current_seed = (int(seed) + i * 123) if seed is not None else None
-            sps.append({
+            yield {
                 "index": i, 
                 "seed": current_seed, 
-                "structured_prompt": sp
-            })
+                "patch": patch or {}
+            }
+            i += 1
 
-        # 5. Guardar Plan
+    async def _save_plan(
+        self,
+        prompt: str,
+        seed: Optional[int],
+        base_sp: Dict[str, Any],
+        sps: List[Dict[str, Any]],
+        on_step: Optional[StepCallback] = None
+    ) -> Dict[str, Any]:
+        # 5. Guardar Plan (prompt base una vez + patch por variación, JSON compacto)
         plan_id = "plan_" + uuid.uuid4().hex[:10]
         plan = {
             "plan_id": plan_id,
             "base_seed": seed,
             "prompt": prompt,
+            "base_structured_prompt": base_sp,
             "structured_prompts": sps,
             "created_at": str(datetime.datetime.now())
         }
         
         try:
             (self.data_dir / f"{plan_id}.json").write_text(
-                json.dumps(plan, ensure_ascii=False, indent=2), 
+                json.dumps(plan, ensure_ascii=False, separators=(",", ":")), 
                 encoding="utf-8"
             )
         except Exception as e:
             logger.warning(f"No se pudo guardar archivo del plan: {e}")
 
-        if on_step: on_step("PLAN_SAVED", {"plan_id": plan_id})
+        await _emit(on_step, "PLAN_SAVED", {"plan_id": plan_id})
         return plan
 
-    def execute_plan_stepwise(
+    async def generate_plan(
+        self,
+        prompt: str,
+        image_b64: str,
+        brand_guidelines: Optional[str],
+        variations: int,
+        on_step: Optional[StepCallback] = None,
+        image_hash: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Fase 1: Generación del Plan.
+        Obtiene prompt base, aplica RAG y genera variaciones con LLM.
+        """
+        base_sp, seed, ctx = await self._prepare_plan(prompt, image_b64, brand_guidelines, on_step, image_hash)
+        sps = [item async for item in self._iter_variations(prompt, base_sp, seed, ctx, variations, on_step)]
+        return await self._save_plan(prompt, seed, base_sp, sps, on_step)
+
+    @staticmethod
+    def variation_prompt(plan: Dict[str, Any], item: Dict[str, Any]) -> Dict[str, Any]:
+        """Structured prompt completo de una variación (planes con patch o legados)."""
+        if "structured_prompt" in item:
+            return item["structured_prompt"]
+        return prompt_patch.merge(plan.get("base_structured_prompt") or {}, item.get("patch"))
+
+    async def _generate_image(
+        self,
+        item: Dict[str, Any],
+        structured_prompt: Dict[str, Any],
+        aspect_ratio: str,
+        k: int,
+        total: int,
+        semaphore: asyncio.Semaphore,
+        on_step: Optional[StepCallback] = None
+    ) -> str:
+        """Envía una variación a Bria y espera su resultado vía el poller central."""
+        idx = item["index"]
+        async with semaphore:
+            await _emit(on_step, "IMAGE_SUBMIT", {"k": k, "total": total, "index": idx})
+            sp_str = json.dumps(structured_prompt, ensure_ascii=False)
+            
+            # Iniciar generación (async en Bria: devuelve status_url)
+            init = await self.bria.aimage_generate(sp_str, item.get("seed"), aspect_ratio)
+            status_url = init.get("status_url")
+
+            if status_url:
+                await _emit(on_step, "IMAGE_POLL", {"k": k, "total": total, "index": idx, "status_url": status_url})
+                done = await get_status_poller().wait(status_url)
+            else:
+                done = init
+
+        # Verificar resultado
+        if (done.get("status") or "").upper() not in ["COMPLETED", "SUCCESS", "DONE"]:
+             # Intento de recuperar URL si viene directo aunque status no sea standard
+             res = done.get("result", {})
+             if not (res.get("image_url") or res.get("image_urls")):
+                 raise Exception(f"Status not completed: {done.get('status')}")
+
+        res = done.get("result") or {}
+        # Bria v2 devuelve lista en image_urls usualmente
+        image_urls = res.get("image_urls", [])
+        image_url = image_urls[0] if image_urls else res.get("image_url")
+        
+        if not image_url:
+             raise Exception("No image_url in response")
+        return image_url
+
+    async def _execute_items(
+        self,
+        plan: Dict[str, Any],
+        items: AsyncIterable[Dict[str, Any]],
+        total: int,
+        aspect_ratio: str,
+        on_step: Optional[StepCallback] = None,
+        max_concurrency: Optional[int] = None
+    ) -> List[str]:
+        """
+        Lanza cada variación apenas llega de `items` (hasta `max_concurrency`
+        en vuelo) y emite IMAGE_DONE / IMAGE_ERROR en orden de finalización.
+        Devuelve las URLs en el orden del plan.
+        """
+        semaphore = asyncio.Semaphore(max(1, max_concurrency or settings.BRIA_MAX_CONCURRENCY))
+        by_k: Dict[int, str] = {}
+        done_count = 0
+
+        async def run_one(k: int, item: Dict[str, Any]) -> None:
+            nonlocal done_count
+            idx = item["index"]
+            try:
+                sp = self.variation_prompt(plan, item)
+                image_url = await self._generate_image(item, sp, aspect_ratio, k, total, semaphore, on_step)
+            except Exception as e:
+                done_count += 1
+                logger.error(f"Error generando imagen {k}: {e}")
+                await _emit(on_step, "IMAGE_ERROR", {"k": k, "total": total, "index": idx, "done": done_count, "error": str(e)})
+                return
+            done_count += 1
+            by_k[k] = image_url
+            await _emit(on_step, "IMAGE_DONE", {"k": k, "total": total, "index": idx, "done": done_count, "image_url": image_url})
+
+        tasks: List[asyncio.Task] = []
+        try:
+            k = 0
+            async for item in items:
+                k += 1
+                tasks.append(asyncio.create_task(run_one(k, item)))
+            await asyncio.gather(*tasks)
+        finally:
+            # Si se cancela la ejecución, no dejar generaciones huérfanas
+            for task in tasks:
+                task.cancel()
+
+        return [by_k[k] for k in sorted(by_k)]
+
+    async def execute_plan_stepwise(
         self, 
         plan: Dict[str, Any], 
         aspect_ratio: str, 
-        on_step=None
+        on_step: Optional[StepCallback] = None,
+        max_concurrency: Optional[int] = None
     ) -> Dict[str, Any]:
         """
         Fase 2: Ejecución del Plan.
-        Genera las imágenes una por una usando Bria.
+        Envía todas las variaciones a Bria y las espera en paralelo (hasta
+        `max_concurrency` en vuelo, por defecto BRIA_MAX_CONCURRENCY).
+        IMAGE_DONE / IMAGE_ERROR se emiten en orden de finalización, con
+        `done` = imágenes terminadas hasta el momento; `results` queda en el
+        orden del plan.
         """
-        results = []
         items = plan.get("structured_prompts", [])
-        total = len(items)
-
-        for k, item in enumerate(items, start=1):
-            idx = item["index"]
-            if on_step: on_step("IMAGE_SUBMIT", {"k": k, "total": total, "index": idx})
-
-            try:
-                sp_str = json.dumps(item["structured_prompt"], ensure_ascii=False)
-                
-                # Iniciar generación
-                init = self.bria.image_generate(sp_str, item.get("seed"), aspect_ratio)
-                status_url = init.get("status_url") 
-
-                if status_url:
-                    if on_step: on_step("IMAGE_POLL", {"k": k, "total": total, "index": idx, "status_url": status_url})
-                    done = self.bria.poll_until_done(status_url)
-                else:
-                    done = init
-
-                # Verificar resultado
-                if (done.get("status") or "").upper() not in ["COMPLETED", "SUCCESS", "DONE"]:
-                     # Intento de recuperar URL si viene directo aunque status no sea standard
-                     res = done.get("result", {})
-                     if not (res.get("image_url") or res.get("image_urls")):
-                         raise Exception(f"Status not completed: {done.get('status')}")
-
-                res = done.get("result") or {}
-                # Bria v2 devuelve lista en image_urls usualmente
-                image_urls = res.get("image_urls", [])
-                image_url = image_urls[0] if image_urls else res.get("image_url")
-                
-                if not image_url:
-                     raise Exception("No image_url in response")
+        plan["results"] = await self._execute_items(
+            plan, _aiter(items), len(items), aspect_ratio, on_step, max_concurrency
+        )
+        return plan
 
-                results.append(image_url)
-                
-                if on_step: on_step("IMAGE_DONE", {"k": k, "total": total, "index": idx, "image_url": image_url})
+    async def generate_and_execute(
+        self,
+        prompt: str,
+        image_b64: str,
+        brand_guidelines: Optional[str],
+        variations: int,
+        aspect_ratio: str,
+        on_plan_step: Optional[StepCallback] = None,
+        on_img_step: Optional[StepCallback] = None,
+        image_hash: Optional[str] = None,
+        max_concurrency: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Fases 1 y 2 solapadas: cada variación se envía a Bria en cuanto el LLM
+        cierra su patch, sin esperar el plan completo. PLAN_SAVED llega cuando
+        termina el stream del LLM (las primeras imágenes pueden estar en curso).
+        """
+        base_sp, seed, ctx = await self._prepare_plan(prompt, image_b64, brand_guidelines, on_plan_step, image_hash)
+        sps: List[Dict[str, Any]] = []
+        plan: Dict[str, Any] = {"base_structured_prompt": base_sp}
 
-            except Exception as e:
-                logger.error(f"Error generando imagen {k}: {e}")
-                if on_step: on_step("IMAGE_ERROR", {"k": k, "total": total, "index": idx, "error": str(e)})
+        async def streamed_items() -> AsyncIterator[Dict[str, Any]]:
+            async for item in self._iter_variations(prompt, base_sp, seed, ctx, variations, on_plan_step):
+                sps.append(item)
+                yield item
+            plan.update(await self._save_plan(prompt, seed, base_sp, sps, on_plan_step))
 
+        results = await self._execute_items(plan, streamed_items(), variations, aspect_ratio, on_img_step, max_concurrency)
         plan["results"] = results
         return plan
 
-    def run_pipeline(self, job: Job) -> None:
+    async def run_pipeline(self, job: Job) -> None:
         """
         Ejecuta todo el pipeline para un job dado.
-        Es seguro ejecutar esto en un threadpool (síncrono).
+        Debe correr en el event loop (las llamadas a Bria y MongoDB son async).
         """
         try:
-            update_job(job.job_id, stage=JobStage.STARTED, progress=5)
-            add_event(job.job_id, "Iniciando pipeline de generación...")
+            await update_job(job.job_id, stage=JobStage.STARTED, progress=5)
+            await add_event(job.job_id, "Iniciando pipeline de generación...")
 
-            # Cargar imagen
-            image_b64 = self._load_image_base64(job.image_path)
-            if not image_b64:
-                 fail_job(job.job_id, "No se pudo cargar la imagen de referencia")
+            # Cargar imagen (preprocesada; lectura de disco y Pillow en un thread)
+            loaded = await asyncio.to_thread(self._load_reference_image, job.image_path, job.image_hash)
+            if not loaded:
+                 await fail_job(job.job_id, "No se pudo cargar la imagen de referencia")
                  return
+            image_b64, image_hash = loaded
+
+            # Las imágenes empiezan antes de PLAN_SAVED (ver generate_and_execute)
+            images_started = False
 
             # Callbacks para actualizar el Job
-            def on_plan_step(stage_name, payload):
+            async def on_plan_step(stage_name, payload):
                 if stage_name == "BRIA_SP_REQUEST":
-                    update_job(job.job_id, stage=JobStage.BRIA_SP_REQUEST, progress=10)
-                    add_event(job.job_id, "Solicitando análisis de imagen a Bria...")
+                    await update_job(job.job_id, stage=JobStage.BRIA_SP_REQUEST, progress=10)
+                    await add_event(job.job_id, "Solicitando análisis de imagen a Bria...")
                 elif stage_name == "BRIA_SP_POLL":
-                    add_event(job.job_id, "Esperando respuesta de Bria (Analysis)...")
+                    await add_event(job.job_id, "Esperando respuesta de Bria (Analysis)...")
+                elif stage_name == "BRIA_SP_CACHED":
+                    await update_job(job.job_id, progress=15)
+                    await add_event(job.job_id, "Análisis de imagen recuperado de cache.")
                 elif stage_name == "RAG_CONTEXT":
-                    update_job(job.job_id, stage=JobStage.RAG_CONTEXT, progress=20)
-                    add_event(job.job_id, "Cargando guías de marca y contexto...")
+                    await update_job(job.job_id, stage=JobStage.RAG_CONTEXT, progress=20)
+                    await add_event(job.job_id, "Cargando guías de marca y contexto...")
                 elif stage_name == "LLM_PATCHES":
-                    update_job(job.job_id, stage=JobStage.LLM_PATCHES, progress=30)
+                    await update_job(job.job_id, stage=JobStage.LLM_PATCHES, progress=30)
                     model = payload.get("model", "LLM")
-                    add_event(job.job_id, f"Diseñando variaciones con {model}...")
+                    await add_event(job.job_id, f"Diseñando variaciones con {model}...")
                 elif stage_name == "PLAN_SAVED":
-                    update_job(job.job_id, stage=JobStage.PLAN_SAVED, progress=40, plan_id=payload.get("plan_id"))
-                    add_event(job.job_id, "Plan de generación creado exitosamente.")
-
-            # Generar Plan
-            plan = self.generate_plan(
-                job.prompt, 
-                image_b64, 
-                job.brand_guidelines, 
-                job.variations, 
-                on_step=on_plan_step
-            )
-
-            job_total = len(plan.get("structured_prompts", []))
-            # Actualizamos total en job internal attributes si los tuviera, o inferimos en progreso
-            
-            def on_img_step(stage_name, payload):
+                    if images_started:
+                        # No retroceder etapa/progreso de las imágenes ya en curso
+                        await update_job(job.job_id, plan_id=payload.get("plan_id"))
+                    else:
+                        await update_job(job.job_id, stage=JobStage.PLAN_SAVED, progress=40, plan_id=payload.get("plan_id"))
+                    await add_event(job.job_id, "Plan de generación creado exitosamente.")
+
+            async def on_img_step(stage_name, payload):
+                nonlocal images_started
                 k = payload.get("k", 1)
                 total = payload.get("total", 1)
                 
-                # Calcular progreso lineal entre 40% y 100%
+                # Calcular progreso lineal entre 40% y 100% según imágenes terminadas
+                # (las variaciones corren en paralelo y terminan en cualquier orden)
                 base_progress = 40
                 remaining_percent = 60
-                
-                # Progreso por imagen
                 step_val = remaining_percent / max(total, 1)
-                current_base = base_progress + (step_val * (k - 1))
                 
                 if stage_name == "IMAGE_SUBMIT":
-                    update_job(job.job_id, stage=JobStage.IMAGE_POLL, progress=current_base + (step_val * 0.1))
-                    add_event(job.job_id, f"Generando variación {k}/{total}...")
+                    if not images_started:
+                        images_started = True
+                        await update_job(job.job_id, stage=JobStage.IMAGE_POLL, progress=base_progress + (step_val * 0.1))
+                    await add_event(job.job_id, f"Generando variación {k}/{total}...")
                 elif stage_name == "IMAGE_POLL":
                      # No spamear logs
                      pass
                 elif stage_name == "IMAGE_DONE":
-                    update_job(job.job_id, progress=current_base + step_val)
+                    await update_job(job.job_id, progress=base_progress + step_val * payload.get("done", k))
                     url = payload.get("image_url")
                     idx = payload.get("index")
                     
-                    add_partial_result(job.job_id, {"index": idx, "image_url": url})
-                    add_event(job.job_id, f"✅ Variación {k} lista")
+                    await add_partial_result(job.job_id, {"index": idx, "image_url": url})
+                    await add_event(job.job_id, f"✅ Variación {k} lista")
                 elif stage_name == "IMAGE_ERROR":
-                    add_event(job.job_id, f"⚠️ Error en variación {k}: {payload.get('error')}")
+                    await update_job(job.job_id, progress=base_progress + step_val * payload.get("done", k))
+                    await add_event(job.job_id, f"⚠️ Error en variación {k}: {payload.get('error')}")
 
-            # Ejecutar Plan
-            final_plan = self.execute_plan_stepwise(
-                plan, 
+            # Generar Plan y ejecutarlo a medida que llegan los patches del LLM
+            final_plan = await self.generate_and_execute(
+                job.prompt, 
+                image_b64, 
+                job.brand_guidelines, 
+                job.variations, 
                 job.aspect_ratio or "1:1", 
-                on_step=on_img_step
+                on_plan_step=on_plan_step,
+                on_img_step=on_img_step,
+                image_hash=image_hash
             )
             
             results = final_plan.get("results", [])
-            complete_job(job.job_id, results)
+            await complete_job(job.job_id, results)
 
         except Exception as e:
             logger.exception(f"Error crítico en pipeline job {job.job_id}")
-            fail_job(job.job_id, str(e), traceback.format_exc())
+            await fail_job(job.job_id, str(e), traceback.format_exc())
 
 
 # Singleton instance
@@ -0,0 +1,90 @@
+"""
+Patches de structured prompts
+Un plan guarda el structured prompt base una sola vez y, por variación, solo
+las claves que cambian. Los prompts completos se materializan al leerlos.
+"""
+
+import copy
+from typing import Dict, Any, List, Optional
+from app.schemas.fibo import Plan
+
+
+def deep_update(dst: Dict[str, Any], src: Dict[str, Any]) -> Dict[str, Any]:
+    """Actualización recursiva de diccionarios."""
+    for k, v in src.items():
+        if isinstance(v, dict) and isinstance(dst.get(k), dict):
+            deep_update(dst[k], v)
+        else:
+            dst[k] = v
+    return dst
+
+
+def merge(base: Dict[str, Any], patch: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Prompt completo = base + patch (no modifica ninguno de los dos)."""
+    merged = copy.deepcopy(base)
+    if patch:
+        deep_update(merged, copy.deepcopy(patch))
+    return merged
+
+
+def diff(base: Dict[str, Any], target: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Patch mínimo tal que merge(base, patch) == target.
+    Devuelve None si target elimina claves de base (deep_update no puede expresarlo).
+    """
+    if any(k not in target for k in base):
+        return None
+    patch: Dict[str, Any] = {}
+    for k, v in target.items():
+        if k not in base:
+            patch[k] = v
+        elif isinstance(v, dict) and isinstance(base[k], dict):
+            sub = diff(base[k], v)
+            if sub is None:
+                return None
+            if sub:
+                patch[k] = sub
+        elif base[k] != v:
+            patch[k] = v
+    return patch
+
+
+def variation_prompt(plan: Plan, index: int) -> Optional[Dict[str, Any]]:
+    """Structured prompt completo de una variación (formato compacto o legado)."""
+    variation = plan.proposed_variations[index]
+    if variation.json_prompt is not None:
+        return variation.json_prompt
+    if variation.json_prompt_patch is not None and plan.base_json_prompt is not None:
+        return merge(plan.base_json_prompt, variation.json_prompt_patch)
+    return None
+
+
+def expand_plan(plan: Plan) -> Plan:
+    """Materializa json_prompt en cada variación (para responder a la API)."""
+    prompts = [variation_prompt(plan, i) for i in range(len(plan.proposed_variations))]
+    for variation, prompt in zip(plan.proposed_variations, prompts):
+        variation.json_prompt = prompt
+        variation.json_prompt_patch = None
+    plan.base_json_prompt = None
+    return plan
+
+
+def compact_plan(plan: Plan) -> Plan:
+    """
+    Reescribe el plan como base + patches antes de persistirlo.
+    La base es el prompt de la primera variación que lo tenga; las variaciones
+    que no se pueden expresar como patch conservan su json_prompt completo.
+    """
+    expand_plan(plan)
+    prompts: List[Optional[Dict[str, Any]]] = [v.json_prompt for v in plan.proposed_variations]
+    base = next((p for p in prompts if isinstance(p, dict)), None)
+    if base is None:
+        return plan
+
+    for variation, prompt in zip(plan.proposed_variations, prompts):
+        patch = diff(base, prompt) if isinstance(prompt, dict) else None
+        if patch is not None:
+            variation.json_prompt = None
+            variation.json_prompt_patch = patch
+    plan.base_json_prompt = base
+    return plan
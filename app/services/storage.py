@@ -1,11 +1,16 @@
 # app/services/storage.py
+import asyncio
 import boto3
+import hashlib
 import os
-from botocore.exceptions import NoCredentialsError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError, NoCredentialsError
 from fastapi import UploadFile
+from pymongo.errors import DuplicateKeyError
 import uuid
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
 from urllib.parse import urlparse
+from app.schemas.fibo import StoredImage
 
 # Cargar config
 ENDPOINT_URL = os.getenv("SUPABASE_ENDPOINT_URL")
@@ -17,6 +22,12 @@ REGION = os.getenv("SUPABASE_REGION")
 if not all([ENDPOINT_URL, ACCESS_KEY, SECRET_KEY, BUCKET_NAME]):
     raise ValueError("Missing Supabase environment variables.")
 
+# Límites de subida: multipart por encima del umbral, en partes de CHUNK_MB
+UPLOAD_MAX_CONCURRENCY = int(os.getenv("UPLOAD_MAX_CONCURRENCY", "8"))
+UPLOAD_MULTIPART_THRESHOLD_MB = int(os.getenv("UPLOAD_MULTIPART_THRESHOLD_MB", "8"))
+UPLOAD_CHUNK_MB = int(os.getenv("UPLOAD_CHUNK_MB", "8"))
+PRESIGNED_URL_EXPIRES_SEC = int(os.getenv("PRESIGNED_URL_EXPIRES_SEC", "900"))
+
 s3_client = boto3.client(
     's3',
     endpoint_url=ENDPOINT_URL,
@@ -25,9 +36,59 @@ s3_client = boto3.client(
     region_name=REGION
 )
 
-async def upload_image_to_supabase(file: UploadFile, user_id: str) -> Optional[str]:
-    """Sube archivo a Supabase Storage en carpeta del usuario y devuelve URL pública."""
-    
+transfer_config = TransferConfig(
+    multipart_threshold=UPLOAD_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=UPLOAD_CHUNK_MB * 1024 * 1024,
+    max_concurrency=4,  # Partes en paralelo por archivo
+    use_threads=True
+)
+
+# Subidas simultáneas por proceso (cada una ocupa un hilo del threadpool)
+_upload_semaphore = asyncio.Semaphore(UPLOAD_MAX_CONCURRENCY)
+
+
+def _public_url(key: str) -> str:
+    # Parcing the endpoint URL to extract hostname
+    parsed_url = urlparse(ENDPOINT_URL)
+    hostname = parsed_url.hostname
+    assert hostname is not None, "Could not parse hostname"
+    return f"https://{hostname}/storage/v1/object/public/{BUCKET_NAME}/{key}"
+
+
+async def upload_fileobj(fileobj, key: str, content_type: Optional[str]) -> str:
+    """
+    Sube un file-like al bucket sin bloquear el event loop.
+    boto3 lee el archivo por partes (multipart para archivos grandes) en un
+    hilo del threadpool; el semáforo acota las subidas concurrentes.
+    """
+    extra_args = {'ContentType': content_type} if content_type else {}
+    async with _upload_semaphore:
+        await asyncio.to_thread(
+            s3_client.upload_fileobj,
+            fileobj,
+            BUCKET_NAME,
+            key,
+            ExtraArgs=extra_args,
+            Config=transfer_config
+        )
+    return _public_url(key)
+
+def _hash_fileobj(fileobj, chunk_size: int = 1024 * 1024) -> Tuple[str, int]:
+    """sha256 y tamaño leyendo por bloques; deja el archivo al inicio."""
+    digest = hashlib.sha256()
+    size = 0
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest(), size
+
+
+def _file_extension(file: UploadFile) -> str:
     # Secure Extension Handling
     file_extension = ""
     if file.filename:
@@ -35,32 +96,195 @@ async def upload_image_to_supabase(file: UploadFile, user_id: str) -> Optional[s
         if ext: file_extension = ext.lstrip(".")
     if not file_extension and file.content_type:
         file_extension = file.content_type.split("/")[-1].split("+")[0]
-    file_extension = file_extension or "bin"
-    
-    # Organize files by user_id
+    return file_extension or "bin"
+
+
+def _valid_user_id(user_id: str) -> bool:
     # Sanitize user_id to prevent path traversal
-    if not user_id or "/" in user_id or "\\" in user_id or ".." in user_id:
+    return bool(user_id) and "/" not in user_id and "\\" not in user_id and ".." not in user_id
+
+
+async def find_stored(user_id: str, sha256: str) -> Optional[StoredImage]:
+    return await StoredImage.find_one(StoredImage.user_id == user_id, StoredImage.sha256 == sha256)
+
+
+async def register_stored(
+    user_id: str,
+    sha256: str,
+    key: str,
+    size: int,
+    content_type: Optional[str]
+) -> StoredImage:
+    """Registra un objeto ya subido en el índice; si el contenido ya estaba, devuelve el registro existente."""
+    stored = StoredImage(
+        user_id=user_id,
+        sha256=sha256,
+        key=key,
+        url=_public_url(key),
+        size=size,
+        content_type=content_type
+    )
+    try:
+        await stored.insert()
+    except DuplicateKeyError:
+        # Subida concurrente del mismo archivo: gana el primer registro
+        return await find_stored(user_id, sha256) or stored
+    return stored
+
+
+async def store_fileobj(
+    fileobj,
+    user_id: str,
+    sha256: str,
+    size: int,
+    content_type: Optional[str],
+    ext: str,
+    folder: str = ""
+) -> StoredImage:
+    """Sube un archivo ya hasheado bajo `{user_id}/{folder}{sha256}.{ext}` y lo registra en el índice."""
+    key = f"{user_id}/{folder}{sha256}.{ext}"
+    await upload_fileobj(fileobj, key, content_type)
+    return await register_stored(user_id, sha256, key, size, content_type)
+
+
+async def store_image(file: UploadFile, user_id: str) -> Optional[StoredImage]:
+    """
+    Sube una imagen con clave direccionada por contenido `{user_id}/{sha256}.{ext}`.
+    Si el usuario ya subió el mismo archivo, devuelve el registro existente
+    sin hacer el PUT a S3. El sha256 sirve de identidad estable de la imagen.
+    """
+    if not _valid_user_id(user_id):
         print(f"Invalid user_id format: {user_id}")
         return None
     
-    unique_filename = f"{user_id}/{uuid.uuid4()}.{file_extension}"
-    
     try:
-        s3_client.upload_fileobj(
-            file.file,
-            BUCKET_NAME,
-            unique_filename,
-            ExtraArgs={'ContentType': file.content_type} 
-        )
+        # El UploadFile ya está en disco/memoria local (spooled): hashear es local
+        sha256, size = await asyncio.to_thread(_hash_fileobj, file.file)
         
-        # Parcing the endpoint URL to extract hostname
-        parsed_url = urlparse(ENDPOINT_URL)
-        hostname = parsed_url.hostname
-        assert hostname is not None, "Could not parse hostname"
-        public_url = f"https://{hostname}/storage/v1/object/public/{BUCKET_NAME}/{unique_filename}"
+        existing = await find_stored(user_id, sha256)
+        if existing:
+            return existing
         
-        return public_url
+        return await store_fileobj(
+            file.file, user_id, sha256, size, file.content_type, _file_extension(file)
+        )
 
     except Exception as e:
         print(f"Error S3: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+async def upload_image_to_supabase(file: UploadFile, user_id: str) -> Optional[str]:
+    """Sube archivo a Supabase Storage en carpeta del usuario y devuelve URL pública."""
+    stored = await store_image(file, user_id)
+    return stored.url if stored else None
+
+
+def direct_upload_prefix(user_id: str) -> str:
+    """Prefijo reservado a las subidas directas (presigned) de un usuario."""
+    return f"{user_id}/uploads/"
+
+
+def create_presigned_upload(
+    user_id: str,
+    filename: Optional[str],
+    content_type: str,
+    max_bytes: int
+) -> Optional[Dict[str, Any]]:
+    """
+    Genera un POST prefirmado para que el cliente suba la imagen directo al
+    bucket (los bytes no pasan por la API). La política fija el Content-Type y
+    acota el tamaño con `content-length-range`. La firma es local, sin red.
+    """
+    if not _valid_user_id(user_id):
+        print(f"Invalid user_id format: {user_id}")
+        return None
+    
+    ext = ""
+    if filename:
+        _, ext = os.path.splitext(filename)
+        ext = ext.lstrip(".")
+    ext = ext or content_type.split("/")[-1].split("+")[0] or "bin"
+    key = f"{direct_upload_prefix(user_id)}{uuid.uuid4()}.{ext}"
+    
+    post = s3_client.generate_presigned_post(
+        BUCKET_NAME,
+        key,
+        Fields={"Content-Type": content_type},
+        Conditions=[
+            {"Content-Type": content_type},
+            ["content-length-range", 1, max_bytes],
+        ],
+        ExpiresIn=PRESIGNED_URL_EXPIRES_SEC
+    )
+    return {
+        "key": key,
+        "upload_url": post["url"],
+        "method": "POST",
+        # multipart/form-data: estos campos primero y el archivo como campo "file" al final
+        "fields": post["fields"],
+        "max_bytes": max_bytes,
+        "expires_in": PRESIGNED_URL_EXPIRES_SEC,
+    }
+
+
+# Firmas (magic numbers) de los formatos de imagen aceptados
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+SNIFF_BYTES = 16
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Tipo real de la imagen según sus primeros bytes; None si no es un formato aceptado."""
+    for signature, content_type in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def _read_object_head(key: str, length: int) -> bytes:
+    body = s3_client.get_object(Bucket=BUCKET_NAME, Key=key, Range=f"bytes=0-{length - 1}")["Body"]
+    try:
+        return body.read(length)
+    finally:
+        body.close()
+
+
+async def read_object_head(key: str, length: int = SNIFF_BYTES) -> Optional[bytes]:
+    """Primeros `length` bytes del objeto (GET con Range) o None si no existe."""
+    try:
+        return await asyncio.to_thread(_read_object_head, key, length)
+    except ClientError:
+        return None
+
+
+async def head_object(key: str) -> Optional[Dict[str, Any]]:
+    """Metadata del objeto (ContentLength, ContentType, ETag) o None si no existe."""
+    try:
+        return await asyncio.to_thread(s3_client.head_object, Bucket=BUCKET_NAME, Key=key)
+    except ClientError:
+        return None
+
+
+async def delete_object(key: str) -> None:
+    try:
+        await asyncio.to_thread(s3_client.delete_object, Bucket=BUCKET_NAME, Key=key)
+    except ClientError as e:
+        print(f"Error S3 delete: {e}")
+
+
+def public_url_for(key: str) -> str:
+    return _public_url(key)
+
+
+def is_own_url(url: Optional[str]) -> bool:
+    """True si la URL apunta a nuestro bucket (ya espejada / subida por nosotros)."""
+    if not url:
+        return False
+    return url.startswith(_public_url(""))
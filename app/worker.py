@@ -0,0 +1,123 @@
+"""
+Worker de generación independiente de la API
+Reclama jobs de la cola durable en MongoDB y los ejecuta con concurrencia
+configurable. Uso:
+
+    python -m app.worker --concurrency 4
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+from typing import Optional, Set
+from dotenv import load_dotenv
+load_dotenv()
+from app.core.config import settings
+from app.core.db import init_db
+from app.services import job_queue
+from app.services.http_client import close_http_client
+from app.services.bria_poller import shutdown_status_poller
+from app.services.job_buffer import shutdown_job_buffer
+from app.services import background
+from app.services.derivatives import shutdown_process_pool
+
+logger = logging.getLogger("app.worker")
+
+
+class JobWorker:
+    """Loop de claim/ejecución con un máximo de `concurrency` jobs en vuelo."""
+
+    def __init__(
+        self,
+        concurrency: int,
+        poll_interval: float,
+        worker_id: Optional[str] = None,
+        shutdown_grace: Optional[float] = None
+    ):
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or job_queue.default_worker_id()
+        self.shutdown_grace = settings.JOB_SHUTDOWN_GRACE_SEC if shutdown_grace is None else shutdown_grace
+        self._stopping = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    async def run(self) -> None:
+        slots = asyncio.Semaphore(self.concurrency)
+        logger.info(f"Worker {self.worker_id} iniciado (concurrency={self.concurrency})")
+        
+        while not self._stopping.is_set():
+            await slots.acquire()
+            try:
+                job = await job_queue.claim_next(self.worker_id)
+            except Exception as e:
+                logger.error(f"Error reclamando job: {e}")
+                job = None
+            
+            if job is None:
+                slots.release()
+                await self._idle()
+                continue
+            
+            logger.info(f"Job {job.job_id} reclamado (intento {job.attempts}/{job.max_attempts})")
+            task = asyncio.create_task(job_queue.run_job(job, self.worker_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+        
+        # Apagado: esperar los jobs en vuelo un tiempo acotado; los que no
+        # terminen se cancelan y el lease vencido los devuelve a la cola
+        if self._tasks:
+            logger.info(f"Esperando {len(self._tasks)} jobs en ejecución (máx. {self.shutdown_grace}s)...")
+            _, still_running = await asyncio.wait(set(self._tasks), timeout=self.shutdown_grace)
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+            if still_running:
+                logger.info(f"{len(still_running)} jobs cancelados; se reintentarán al vencer su lease")
+
+    async def _idle(self) -> None:
+        try:
+            await job_queue.fail_abandoned()
+        except Exception as e:
+            logger.error(f"Error revisando jobs abandonados: {e}")
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def main(concurrency: int, poll_interval: float) -> None:
+    if not await init_db():
+        raise SystemExit("MONGO_URI es requerido para el worker")
+    
+    worker = JobWorker(concurrency, poll_interval)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, worker.stop)
+        except NotImplementedError:
+            # Windows: Ctrl+C llega como KeyboardInterrupt
+            pass
+    
+    try:
+        await worker.run()
+    finally:
+        await background.drain(settings.JOB_SHUTDOWN_GRACE_SEC)
+        shutdown_process_pool()
+        await shutdown_job_buffer()
+        await shutdown_status_poller()
+        await close_http_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Worker de la cola de generación")
+    parser.add_argument("--concurrency", type=int, default=settings.JOB_WORKER_CONCURRENCY)
+    parser.add_argument("--poll-interval", type=float, default=settings.JOB_QUEUE_POLL_SEC)
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(main(args.concurrency, args.poll_interval))
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app.core.db import init_db, get_collection
+from app.schemas.fibo import Campaign, Product, Plan, Job, JobEvent, StoredImage, CacheEntry
+
+SAMPLE_USER = "index-check-user"
+
+# Consultas representativas de la API y los workers: (modelo, descripción, filtro, sort)
+QUERIES = [
+    (Campaign, "campañas del usuario", {"user_id": SAMPLE_USER}, [("created_at", -1)]),
+    (Product, "productos de una campaña", {"user_id": SAMPLE_USER, "campaign_id": "x"}, [("created_at", -1)]),
+    (Plan, "historial de planes", {"user_id": SAMPLE_USER}, [("created_at", -1), ("_id", -1)]),
+    (Job, "jobs recientes del usuario", {"user_id": SAMPLE_USER}, [("updated_at", -1)]),
+    (Job, "estado de un job", {"job_id": "x"}, None),
+    # Mismo filtro que job_queue._claimable_filter
+    (Job, "claim de la cola", {"$or": [
+        {"stage": "QUEUED", "next_run_at": {"$lte": time.time()}},
+        {"stage": {"$nin": ["QUEUED", "DONE", "ERROR"]}, "lease_expires_at": {"$lt": time.time()}},
+    ]}, [("next_run_at", 1)]),
+    (JobEvent, "últimos eventos de un job", {"job_id": "x"}, [("seq", -1)]),
+    (StoredImage, "deduplicación por hash", {"user_id": SAMPLE_USER, "sha256": "x"}, None),
+    (CacheEntry, "lookup de cache", {"namespace": "x", "key": "x"}, None),
+]
+
+def _stages(plan: dict):
+    """Recorre el winningPlan y devuelve todas sus etapas (COLLSCAN, IXSCAN, SORT...)."""
+    yield plan.get("stage")
+    if "inputStage" in plan:
+        yield from _stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        yield from _stages(child)
+
+async def main():
+    client = await init_db()  # init_beanie crea los índices declarados
+    if not client:
+        print("ERROR: MONGO_URI missing")
+        return
+
+    missing = 0
+    try:
+        for model, label, query, sort in QUERIES:
+            cursor = get_collection(model).find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            explain = await cursor.explain()
+            winning = explain.get("queryPlanner", {}).get("winningPlan", {})
+            # find() con sort puede envolver el plan en queryPlan (SBE)
+            stages = set(_stages(winning.get("queryPlan", winning)))
+
+            problems = []
+            if "COLLSCAN" in stages:
+                problems.append("COLLSCAN")
+            if "SORT" in stages:
+                problems.append("SORT en memoria")
+
+            status = "OK " if not problems else "!! "
+            print(f"{status}{model.Settings.name:<14} {label:<28} {', '.join(problems) or 'IXSCAN'}")
+            missing += bool(problems)
+    finally:
+        client.close()
+
+    print(f"--- {missing} consultas sin cobertura de índice ---")
+
+if __name__ == "__main__":
+    asyncio.run(main())
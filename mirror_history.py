@@ -0,0 +1,37 @@
+import asyncio
+import sys
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app.core.db import init_db
+from app.schemas.fibo import Plan
+from app.services import mirror
+from app.services.http_client import close_http_client
+
+# Retoma los espejados que un reinicio dejó a medias (Plan.mirror_pending).
+# Con --all hace el backfill de todos los planes completados cuyas URLs de
+# Bria todavía no expiraron.
+async def main():
+    client = await init_db()
+    if not client:
+        print("ERROR: MONGO_URI missing")
+        return
+
+    try:
+        if "--all" in sys.argv:
+            plans = await Plan.find(Plan.status == "completed").to_list()
+            print(f"--- Mirroring {len(plans)} completed plans ---")
+        else:
+            plans = await Plan.find(Plan.mirror_pending == True).to_list()  # noqa: E712
+            print(f"--- Resuming {len(plans)} pending mirrors ---")
+        for p in plans:
+            mapping = await mirror.mirror_plan(str(p.id))
+            print(f"ID: {p.id} | User: {p.user_id} | Mirrored: {len(mapping)}")
+    finally:
+        await close_http_client()
+        client.close()
+        print("MongoDB Connection closed.")
+
+if __name__ == "__main__":
+    asyncio.run(main())